@@ -0,0 +1,139 @@
+"""actions.py
+
+Buffered dispatch of unblock and stop_receiving actions to the ReadUntilClient
+
+"""
+import logging
+from timeit import default_timer as timer
+
+from ru.utils import Decision
+
+
+__all__ = ["ActionBuffer"]
+
+logger = logging.getLogger("RU_actions")
+
+
+class ActionBuffer:
+    """Collect read decisions and send them to the client in groups
+
+    Actions are held until `flush` is called, which the analysis loop does once
+    per iteration, or until `max_size` actions are held or the oldest held
+    action has waited `max_wait` seconds. If the client provides
+    `unblock_read_batch` and `stop_receiving_batch` each flush sends at most
+    one request of each kind, otherwise the single read methods are called
+    back to back so that RPC work is not interleaved with classification.
+
+    Parameters
+    ----------
+    client : read_until.ReadUntilClient
+        An instance of the ReadUntilClient object
+    unblock_duration : int or float
+        Time, in seconds, to apply unblock voltage
+    dry_run : bool
+        If True unblocks are replaced with `stop_receiving` actions
+    max_size : int
+        Flush when this many actions are held
+    max_wait : int or float
+        Flush when the oldest held action has waited this many seconds
+    """
+
+    def __init__(self, client, unblock_duration=0.1, dry_run=False, max_size=512, max_wait=0.1):
+        self.client = client
+        self.unblock_duration = unblock_duration
+        self.dry_run = dry_run
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.unblocks = []
+        self.stops = []
+        # When the oldest held action was added, None when none are held
+        self.first_held = None
+        # Running totals, reported by `stats`
+        self.flushes = 0
+        self.sent = 0
+        self.flush_time = 0.0
+
+    def __len__(self):
+        return len(self.unblocks) + len(self.stops)
+
+    def add(self, action, channel, read_number, read_id):
+        """Buffer a Decision for a read, PROCEED is ignored"""
+        if action == Decision.UNBLOCK:
+            self.unblock(channel, read_number, read_id)
+        elif action == Decision.STOP_RECEIVING:
+            self.stop_receiving(channel, read_number)
+
+    def unblock(self, channel, read_number, read_id):
+        if self.dry_run:
+            self.stop_receiving(channel, read_number)
+            return
+        self.unblocks.append((channel, read_number, read_id))
+        self._check()
+
+    def stop_receiving(self, channel, read_number):
+        self.stops.append((channel, read_number))
+        self._check()
+
+    def _check(self):
+        now = timer()
+        if self.first_held is None:
+            self.first_held = now
+        if len(self) >= self.max_size or now - self.first_held >= self.max_wait:
+            self.flush()
+
+    def flush(self):
+        """Send all held actions
+
+        Returns
+        -------
+        int
+            The number of actions sent
+        """
+        self.first_held = None
+        t0 = timer()
+        unblocks, self.unblocks = self.unblocks, []
+        stops, self.stops = self.stops, []
+        n = len(unblocks) + len(stops)
+        if not n:
+            return 0
+
+        if unblocks:
+            if hasattr(self.client, "unblock_read_batch"):
+                self.client.unblock_read_batch(
+                    [(c, num) for c, num, _ in unblocks], duration=self.unblock_duration
+                )
+            else:
+                for channel, read_number, read_id in unblocks:
+                    self.client.unblock_read(channel, read_number, self.unblock_duration, read_id)
+
+        if stops:
+            if hasattr(self.client, "stop_receiving_batch"):
+                self.client.stop_receiving_batch(stops)
+            else:
+                for channel, read_number in stops:
+                    self.client.stop_receiving_read(channel, read_number)
+
+        # Clients that queue actions themselves send them on here
+        flush_actions = getattr(self.client, "flush_actions", None)
+        if flush_actions is not None:
+            flush_actions()
+
+        t1 = timer()
+        self.flushes += 1
+        self.sent += n
+        self.flush_time += t1 - t0
+        logger.debug(
+            "Flushed {} unblock, {} stop_receiving in {:.5f}s".format(
+                len(unblocks), len(stops), t1 - t0
+            )
+        )
+        return n
+
+    def stats(self):
+        """Return a summary string of the actions sent so far"""
+        return "{} actions in {} flushes ({:.1f}/flush, {:.5f}s total)".format(
+            self.sent,
+            self.flushes,
+            self.sent / self.flushes if self.flushes else 0,
+            self.flush_time,
+        )
@@ -0,0 +1,279 @@
+"""aio.py
+
+Asyncio basecall client and event loop for the targets workflow, keeping many
+reads in flight on a single thread
+
+"""
+import asyncio
+import logging
+from timeit import default_timer as timer
+
+from ru.basecall import BASECALL_TIMEOUT, GuppyCaller, _create_guppy_read, _screen
+
+
+__all__ = ["AsyncGuppyCaller", "run_event_loop"]
+
+logger = logging.getLogger("RU_aio")
+
+
+class AsyncGuppyCaller:
+    """Awaitable submit and receive on top of GuppyCaller connections
+
+    Reads are sent with `submit`, which returns a future for the called read.
+    A single task polls every connection for called reads and resolves their
+    futures, sleeping between empty polls with the same backoff as
+    GuppyCaller.basecall_minknow. Each read goes to the connection with the
+    fewest reads in flight.
+
+    Parameters
+    ----------
+    caller : GuppyCaller or GuppyCallerPool
+        Connected basecaller(s), as returned by ru.basecall.get_caller
+    window_overlap : int, optional
+        As for GuppyCaller.basecall_minknow, windowed calls are stitched onto
+        the sequence called for the read so far
+    timeout : int or float, optional
+        Time, in seconds, to wait for each read. Reads not called in time are
+        returned with sequence None and quality BASECALL_TIMEOUT
+    max_in_flight : int, optional
+        Maximum number of reads awaiting results, `submit` waits while it is
+        reached
+    """
+
+    def __init__(self, caller, window_overlap=None, timeout=None, max_in_flight=None):
+        self.callers = getattr(caller, "callers", [caller])
+        self.window_overlap = window_overlap
+        self.timeout = timeout
+        self.slots = None if max_in_flight is None else asyncio.Semaphore(max_in_flight)
+        # {read_id: (caller index, channel, read_number, window, future, submitted)}
+        self.pending = {}
+        self.in_flight = [0] * len(self.callers)
+        self.submitted = asyncio.Event()
+        self.poller = None
+        self.latency = 0.0
+        self.called = 0
+        self.skipped = 0
+
+    def start(self):
+        self.poller = asyncio.ensure_future(self._poll())
+
+    async def close(self):
+        if self.poller is not None:
+            self.poller.cancel()
+            try:
+                await self.poller
+            except asyncio.CancelledError:
+                pass
+        for read_id in list(self.pending):
+            self._release(read_id).cancel()
+
+    def _release(self, read_id):
+        i, _, _, _, future, _ = self.pending.pop(read_id)
+        self.in_flight[i] -= 1
+        if self.slots is not None:
+            self.slots.release()
+        return future
+
+    async def submit(self, channel, read_number, read, window=None):
+        """Send a GuppyRead to the basecaller
+
+        Returns
+        -------
+        asyncio.Future
+            Resolves to (read_info, read_id, sequence, sequence_length, quality)
+        """
+        if self.slots is not None:
+            await self.slots.acquire()
+        i = min(range(len(self.callers)), key=self.in_flight.__getitem__)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[read.read_id] = (i, channel, read_number, window, future, timer())
+        self.in_flight[i] += 1
+        try:
+            self.callers[i].pass_read(read)
+        except Exception as e:
+            self._release(read.read_id)
+            raise e
+        self.submitted.set()
+        return future
+
+    async def receive(self, read_id, future):
+        """Wait for a submitted read, giving BASECALL_TIMEOUT after `timeout`"""
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            if read_id not in self.pending:
+                # Called as the wait timed out
+                return future.result()
+            i, channel, read_number, _, _, _ = self.pending[read_id]
+            self._release(read_id)
+            self.callers[i]._timeout(read_id)
+            return (channel, read_number), read_id, None, 0, BASECALL_TIMEOUT
+
+    async def call(self, channel, read_number, read, window=None):
+        """Submit a read and wait for it to be called"""
+        future = await self.submit(channel, read_number, read, window)
+        return await self.receive(read.read_id, future)
+
+    def _take(self, caller, read, called):
+        if read.read_id in caller.timed_out:
+            # A result for a read that already missed its deadline
+            del caller.timed_out[read.read_id]
+            caller.late += 1
+            return
+        if read.read_id not in self.pending:
+            caller.late += 1
+            return
+        _, channel, read_number, window, future, t = self.pending[read.read_id]
+        self._release(read.read_id)
+        seq, seqlen, qual = called.seq, called.seqlen, called.qual
+        if self.window_overlap is not None:
+            seq, qual = caller._stitch_called(channel, read.read_id, window, seq, qual)
+            seqlen = len(seq)
+        self.called += 1
+        self.latency += timer() - t
+        if not future.done():
+            future.set_result(((channel, read_number), read.read_id, seq, seqlen, qual))
+
+    async def _poll(self):
+        backoff = GuppyCaller.BACKOFF_MIN
+        while True:
+            if not self.pending:
+                self.submitted.clear()
+                await self.submitted.wait()
+            got = 0
+            for caller in self.callers:
+                res = caller._get_called_read()
+                while res is not None:
+                    got += 1
+                    self._take(caller, *res)
+                    res = caller._get_called_read()
+            if got:
+                backoff = GuppyCaller.BACKOFF_MIN
+                # Let waiting reads be handled before polling again
+                await asyncio.sleep(0)
+            else:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, GuppyCaller.BACKOFF_MAX)
+
+    def stats(self):
+        """Return a summary string of reads called on the event loop"""
+        return "{} reads called, mean {:.1f}ms/read, {} in flight, {} chunks not sent".format(
+            self.called,
+            self.latency / self.called * 1000 if self.called else 0.0,
+            len(self.pending),
+            self.skipped,
+        )
+
+
+async def run_event_loop(
+        caller,
+        fetch,
+        align,
+        decide,
+        running,
+        wait,
+        signal_dtype,
+        prev_signal,
+        decided_reads,
+        throttle=0.1,
+        max_batch=512,
+        max_age=None,
+        prescreen=None,
+):
+    """Run the analysis loop on an asyncio event loop
+
+    Chunks are fetched and their reads submitted as soon as they arrive,
+    without waiting for earlier reads to be called. Called reads are taken in
+    the order they finish, mapped in the default executor and passed to
+    `decide` in groups of up to `max_batch`. A chunk for a read that is still
+    being called is added to the read's signal but not sent.
+
+    Parameters
+    ----------
+    caller : AsyncGuppyCaller
+    fetch : callable
+        Returns a list of (channel, rpc.Read), empty if there are none, or
+        None if reads cannot be handled yet. Called in the default executor
+    align : callable
+        Maps a list of called reads, see ru.basecall.Mapper.map_reads_2
+    decide : callable
+        Takes a list of mapped reads and acts on them
+    running : callable
+        Returns False when the loop should stop
+    wait : callable
+        Blocking call, passed a timeout, made in the executor when there are
+        no chunks
+    signal_dtype
+        Numpy dtype of the raw data
+    prev_signal : ru.basecall.SignalStore
+        Signal seen so far for the current read on each channel
+    decided_reads : ru.state.ChannelState
+        Channel state, reads that a decision has been sent for are skipped
+    throttle : int or float
+        Time, in seconds, to wait for chunks when there are none
+    max_batch : int
+        Maximum number of reads passed to `decide` at a time
+    max_age : int or float, optional
+        If given, chunks that waited longer than this many seconds in the
+        read cache are not basecalled and are decided on as STALE
+    prescreen : ru.prescreen.PreScreen, optional
+        Chunks that match a pre-screen rule are not basecalled and are
+        decided on with the rule's outcome
+    """
+    loop = asyncio.get_event_loop()
+    done = asyncio.Queue()
+    caller.start()
+
+    async def handle(channel, read_number, read, window):
+        try:
+            result = await caller.call(channel, read_number, read, window)
+        except Exception as e:
+            logger.warning("Skipping read: {} due to {}".format(read.read_id, e))
+            result = None
+        await done.put(result)
+
+    async def produce():
+        while running():
+            reads = await loop.run_in_executor(None, fetch)
+            if reads is None:
+                await asyncio.sleep(throttle)
+                continue
+            if not reads:
+                await loop.run_in_executor(None, wait, throttle)
+                continue
+            reads, skipped = _screen(
+                reads, signal_dtype, prev_signal, decided_reads, max_age, prescreen
+            )
+            for result in skipped:
+                await done.put(result)
+            for channel, read_number, read, window in _create_guppy_read(
+                reads, signal_dtype, prev_signal, caller.window_overlap
+            ):
+                if decided_reads.is_decided(channel, read_number):
+                    continue
+                if read.read_id in caller.pending:
+                    caller.skipped += 1
+                    continue
+                loop.create_task(handle(channel, read_number, read, window))
+                # Submission can wait on the in-flight cap, so yield to the
+                #  poller and consumer between reads
+                await asyncio.sleep(0)
+
+    async def consume():
+        while running() or not done.empty():
+            try:
+                calls = [await asyncio.wait_for(done.get(), 0.5)]
+            except asyncio.TimeoutError:
+                continue
+            while len(calls) < max_batch and not done.empty():
+                calls.append(done.get_nowait())
+            calls = [c for c in calls if c is not None]
+            batch = await loop.run_in_executor(None, align, calls)
+            decide(batch)
+
+    producer = loop.create_task(produce())
+    try:
+        await asyncio.gather(producer, consume())
+    finally:
+        producer.cancel()
+        await caller.close()
@@ -3,7 +3,15 @@
 Extension of pyguppy Caller that maintains a connection to the basecaller
 
 """
+import copy
 import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from timeit import default_timer as timer
 
 import mappy as mp
 import numpy as np
@@ -11,13 +19,238 @@ import numpy as np
 from pyguppyclient.client import GuppyBasecallerClient
 from pyguppyclient.decode import ReadData as GuppyRead
 
+from ru.index import DEFAULT_PRESET, cached_index
+from ru.map_server import MapClient
+from ru.read_cache import chunk_age
 
-__all__ = ["GuppyCaller"]
+
+__all__ = ["GuppyCaller", "GuppyCallerPool", "Mapper", "SharedGuppyCaller", "SignalStore", "BASECALL_TIMEOUT", "STALE", "NO_SEQ", "get_caller"]
 
 logger = logging.getLogger("RU_basecaller")
 
+# Outcomes given in place of a quality string for reads that were not called
+BASECALL_TIMEOUT = "basecall_timeout"
+STALE = "stale"
+# Outcome given in place of alignments for calls too short to map
+NO_SEQ = "no_seq"
+
+
+class SignalStore:
+    """Per-channel buffers holding the signal of each channel's current read
+
+    Each channel has one preallocated buffer. Chunks of the same read are
+    appended in place and the buffer doubles in size when it is full, so a read
+    of k chunks costs O(k) copying rather than the O(k^2) of concatenating the
+    whole signal on every chunk. When a channel starts a new read its buffer is
+    reused from the start. `append` returns a view of the read's signal so far,
+    which is only valid until the next append on that channel.
+
+    Memory can be bounded in two ways. A read longer than `max_samples` keeps
+    only its newest samples. If growing a buffer would hold more than
+    `max_bytes` in total, the unused space at the end of other buffers is
+    released first, then the buffers of the channels that were appended to
+    least recently are dropped until it fits, and if it still does not fit
+    the read is truncated to the space left. `offset` gives the number of
+    samples of a read dropped from the start of its buffer.
+
+    Parameters
+    ----------
+    dtype : np.dtype, optional
+        dtype of the raw signal, if not given it is set by the first `append`
+    initial_size : int
+        Number of samples allocated for a channel when it is first seen
+    max_bytes : int, optional
+        Budget, in bytes, for all buffers together
+    max_samples : int, optional
+        Maximum number of samples kept for a read
+
+    Examples
+    --------
+    >>> store = SignalStore(np.int16, initial_size=4)
+    >>> store.append(1, "a", np.arange(3, dtype=np.int16).tobytes()).tolist()
+    [0, 1, 2]
+    >>> store.append(1, "a", np.arange(3, dtype=np.int16).tobytes()).tolist()
+    [0, 1, 2, 0, 1, 2]
+    >>> store.append(1, "b", np.arange(2, dtype=np.int16).tobytes()).tolist()
+    [0, 1]
+    >>> store.capacity(1)
+    8
+
+    >>> store = SignalStore(np.int16, initial_size=4, max_bytes=16, max_samples=6)
+    >>> store.append(1, "a", np.arange(4, dtype=np.int16).tobytes()).tolist()
+    [0, 1, 2, 3]
+    >>> store.append(1, "a", np.arange(4, 8, dtype=np.int16).tobytes()).tolist()
+    [2, 3, 4, 5, 6, 7]
+    >>> store.offset(1)
+    2
+    >>> store.append(2, "b", np.arange(4, dtype=np.int16).tobytes()).tolist()
+    [0, 1, 2, 3]
+    >>> 1 in store, store.truncated, store.evicted
+    (False, 1, 1)
+
+    Unused space is released before a channel is dropped
+
+    >>> store = SignalStore(np.int16, initial_size=8, max_bytes=20)
+    >>> _ = store.append(1, "a", np.arange(4, dtype=np.int16).tobytes())
+    >>> store.capacity(1)
+    8
+    >>> _ = store.append(2, "b", np.arange(4, dtype=np.int16).tobytes())
+    >>> store.capacity(1), store.capacity(2), store.evicted
+    (4, 6, 0)
+    """
+
+    def __init__(self, dtype=None, initial_size=8000, max_bytes=None, max_samples=None):
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.initial_size = initial_size
+        self.max_bytes = max_bytes
+        self.max_samples = max_samples
+        # Least recently appended channel first
+        self.buffers = OrderedDict()
+        self.read_ids = {}
+        self.lengths = {}
+        self.offsets = {}
+        self.copied = {}
+        self.held = 0
+        self.peak = 0
+        self.evicted = 0
+        self.truncated = 0
+        self.started_at = timer()
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def __contains__(self, channel):
+        return channel in self.buffers
+
+    def capacity(self, channel):
+        """Return the number of samples allocated for a channel"""
+        buf = self.buffers.get(channel)
+        return 0 if buf is None else len(buf)
+
+    def get(self, channel):
+        """Return (read_id, signal view) for a channel, or None"""
+        if channel not in self.buffers:
+            return None
+        return self.read_ids[channel], self.buffers[channel][: self.lengths[channel]]
+
+    def offset(self, channel):
+        """Return the number of samples of a channel's read no longer held"""
+        return self.offsets.get(channel, 0)
+
+    def _evict(self, channel):
+        self.held -= self.buffers.pop(channel).nbytes
+        self.read_ids.pop(channel, None)
+        self.lengths.pop(channel, None)
+        self.offsets.pop(channel, None)
+        self.evicted += 1
+
+    def _trim(self, channel):
+        # Release the space allocated beyond the end of the channel's read
+        buf = self.buffers[channel]
+        n = self.lengths.get(channel, 0)
+        if len(buf) > n:
+            self.buffers[channel] = buf[:n].copy()
+            self.held -= (len(buf) - n) * self.dtype.itemsize
+
+    def _cap(self, channel, end):
+        """Most samples `channel` may hold, making room for `end` if needed
+
+        Growth slack in other buffers is released before any channel is
+        evicted, so the budget is only spent on signal when it is short.
+        """
+        cap = np.inf if self.max_samples is None else self.max_samples
+        if self.max_bytes is None:
+            return cap
+        own = self.capacity(channel)
+
+        def available():
+            return (self.max_bytes - self.held) // self.dtype.itemsize + own
+
+        for release in (self._trim, self._evict):
+            for other in list(self.buffers):
+                if available() >= min(end, cap):
+                    break
+                if other != channel:
+                    release(other)
+        return min(cap, max(available(), 0))
+
+    def append(self, channel, read_id, raw_data):
+        """Add a chunk of raw data to a channel's current read
+
+        Parameters
+        ----------
+        channel : int
+        read_id : str
+            The read the chunk belongs to, a different read_id starts a new read
+        raw_data : bytes
+            Raw signal as given by MinKNOW
+
+        Returns
+        -------
+        np.ndarray
+            View of the whole signal seen for this read
+        """
+        new = np.frombuffer(raw_data, dtype=self.dtype)
+        buf = self.buffers.get(channel)
+        same = self.read_ids.get(channel) == read_id
+        n = self.lengths.get(channel, 0) if same else 0
+        offset = self.offsets.get(channel, 0) if same else 0
+        end = n + len(new)
+
+        cap = self._cap(channel, end)
+        if end > cap:
+            # Keep only the newest samples of the read
+            new = new[len(new) - min(len(new), cap):]
+            keep = cap - len(new)
+            if keep:
+                buf[:keep] = buf[n - keep:n]
+            offset += end - cap
+            n, end = keep, cap
+            self.truncated += 1
+
+        if buf is None or end > len(buf):
+            old_size = 0 if buf is None else len(buf)
+            size = int(min(max(end, 2 * old_size, self.initial_size), cap))
+            grown = np.empty(size, dtype=self.dtype)
+            if n:
+                grown[:n] = buf[:n]
+                self.copied[channel] = self.copied.get(channel, 0) + n * self.dtype.itemsize
+            self.held += (size - old_size) * self.dtype.itemsize
+            self.peak = max(self.peak, self.held)
+            self.buffers[channel] = buf = grown
 
-def _create_guppy_read(reads, signal_dtype, previous_signal):
+        buf[n:end] = new
+        self.copied[channel] = self.copied.get(channel, 0) + new.nbytes
+        self.read_ids[channel] = read_id
+        self.lengths[channel] = end
+        self.offsets[channel] = offset
+        self.buffers.move_to_end(channel)
+        return buf[:end]
+
+    def stats(self):
+        """Return a summary string of memory held, bytes copied and reads cut"""
+        elapsed = max(timer() - self.started_at, 1e-9)
+        copied = sum(self.copied.values())
+        per_channel = max(self.copied.values(), default=0)
+        largest = max((b.nbytes for b in self.buffers.values()), default=0)
+        return (
+            "{} channels, {:.1f} MiB held (peak {:.1f} MiB, largest channel {:.1f} KiB), "
+            "{:.1f} MiB copied ({:.2f} MiB/s, busiest channel {:.1f} KiB/s), "
+            "{} evicted, {} truncated".format(
+                len(self.buffers),
+                self.held / 2 ** 20,
+                self.peak / 2 ** 20,
+                largest / 2 ** 10,
+                copied / 2 ** 20,
+                copied / 2 ** 20 / elapsed,
+                per_channel / 2 ** 10 / elapsed,
+                self.evicted,
+                self.truncated,
+            )
+        )
+
+
+def _create_guppy_read(reads, signal_dtype, store, window_overlap=None):
     """Convert a read from MinKNOW RPC to GuppyRead
 
     Parameters
@@ -26,45 +259,251 @@ def _create_guppy_read(reads, signal_dtype, previous_signal):
         List of Tuple, containing (channel, read)
     signal_dtype : np.dtype
         A dtype that can be used by numpy to convert the raw data
-    previous_signal : dict
-        Dict containing previous signal segments
+    store : SignalStore
+        Signal seen so far for the current read on each channel
+    window_overlap : int, optional
+        If given, only the newest chunk plus this many samples of the signal
+        before it are converted, otherwise the whole read so far
 
     Yields
     ------
     channel : int
     read_number : int
     GuppyRead
+    window : tuple or None
+        None without `window_overlap`, otherwise (start, total) the first
+        sample of the read in the GuppyRead and the total number of samples in
+        the read, counted from the start of the read even when the store has
+        dropped its oldest samples. A start of 0 means the whole read so far
+        is called.
     """
-    for read_id, channel, read_number, signal in _concat_signal(
-        reads, signal_dtype, previous_signal
-    ):
-        read_obj = GuppyRead(signal, read_id, 0, 1)
-        previous_signal[channel].append((read_id, read_obj.signal))
-        yield channel, read_number, read_obj
+    if store.dtype is None:
+        store.dtype = np.dtype(signal_dtype)
+    for channel, read in reads:
+        signal = store.append(channel, read.id, read.raw_data)
+        window = None
+        if window_overlap is not None:
+            offset = store.offset(channel)
+            total = offset + len(signal)
+            called = total - len(read.raw_data) // store.dtype.itemsize
+            start = max(offset, called - window_overlap)
+            window = (start, total)
+            signal = signal[start - offset:]
+        yield channel, read.number, GuppyRead(signal, read.id, 0, 1), window
 
 
-def _concat_signal(reads, signal_dtype, previous_signal):
-    for channel, read in reads:
-        old_read_id, old_signal = previous_signal.get(
-            channel, (("", np.empty(0, dtype=signal_dtype)),)
-        )[0]
+def _split_stale(reads, signal_dtype, store, max_age=None):
+    """Separate chunks that waited longer than `max_age` seconds to be pulled
 
-        if old_read_id == read.id:
-            signal = np.concatenate(
-                (old_signal, np.frombuffer(read.raw_data, dtype=signal_dtype))
-            )
+    The signal of stale chunks is still added to `store`, so later chunks of
+    the same read are called with it. Chunks without a receive time are never
+    stale.
+
+    Returns
+    -------
+    fresh : list
+        (channel, read) of each chunk to basecall
+    stale : list
+        (channel, read_number, read_id) of each stale chunk
+    """
+    if max_age is None:
+        return reads, []
+    if store.dtype is None:
+        store.dtype = np.dtype(signal_dtype)
+    fresh, stale = [], []
+    now = timer()
+    for chunk in reads:
+        age = chunk_age(chunk, now)
+        if age is not None and age > max_age:
+            channel, read = chunk
+            store.append(channel, read.id, read.raw_data)
+            stale.append((channel, read.number, read.id))
         else:
-            signal = np.frombuffer(read.raw_data, dtype=signal_dtype)
+            fresh.append(chunk)
+    return fresh, stale
+
 
-        yield read.id, channel, read.number, signal
+def _screen(reads, signal_dtype, store, decided_reads, max_age=None, prescreen=None):
+    """Remove chunks that should not be basecalled
+
+    Parameters
+    ----------
+    reads : iterable[Tuple[int, rpc.Read]]
+        (channel, read) chunks
+    signal_dtype
+        Numpy dtype of the raw data
+    store : SignalStore
+        Signal seen so far for the current read on each channel
+    decided_reads : ru.state.ChannelState
+        Channel state, no outcome is given for reads already decided
+    max_age : int or float, optional
+        Chunks that waited longer than this are STALE
+    prescreen : ru.prescreen.PreScreen, optional
+        Chunks that match a pre-screen rule are given its outcome
+
+    Returns
+    -------
+    fresh : list
+        (channel, read) of each chunk to basecall
+    skipped : list
+        (read_info, read_id, None, 0, outcome) of each removed chunk, in the
+        form yielded by GuppyCaller.basecall_minknow
+    """
+    reads, stale = _split_stale(reads, signal_dtype, store, max_age)
+    removed = [(c, n, read_id, STALE) for c, n, read_id in stale]
+    if prescreen:
+        reads, screened = prescreen.split(reads, signal_dtype, store)
+        removed.extend(screened)
+    skipped = [
+        ((channel, read_number), read_id, None, 0, outcome)
+        for channel, read_number, read_id, outcome in removed
+        if not decided_reads.is_decided(channel, read_number)
+    ]
+    return reads, skipped
+
+
+def _stitch(seq, new_seq, overlap_bases, anchor=12):
+    """Return the index in `new_seq` where bases not already in `seq` start
+
+    `new_seq` was called from signal that overlaps the end of the signal that
+    `seq` was called from. The last `anchor` bases of `seq` are searched for
+    near the start of `new_seq`; if they are not found the expected number of
+    overlapping bases is skipped instead.
+
+    Examples
+    --------
+    >>> _stitch("AAAACCCCGGGGTTTT", "GGTTTTACGT", 6, anchor=6)
+    6
+    >>> _stitch("AAAACCCCGGGGTTTT", "CATCATACGT", 6, anchor=6)
+    6
+    >>> _stitch("AAAACCCCGGGGTTTT", "TTTTTACGTACGT", 4, anchor=6)
+    4
+    """
+    k = min(anchor, len(seq))
+    if k:
+        i = new_seq.find(seq[-k:], 0, 2 * overlap_bases + k)
+        if i >= 0:
+            return i + k
+    return min(overlap_bases, len(new_seq))
 
 
 class GuppyCaller(GuppyBasecallerClient):
+    # Bounds, in seconds, of the sleep between polls for called reads
+    BACKOFF_MIN = 0.0005
+    BACKOFF_MAX = 0.02
+    # Number of timed out read ids remembered to recognise late results
+    MAX_TIMED_OUT = 4096
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.connect()
+        self._shared = None
+        self._init_results()
+
+    def _init_results(self):
+        # {channel: (read_id, sequence, quality, samples)} for windowed calls
+        self.sequences = {}
+        # Reads that missed their deadline, and the counts of those and of
+        #  results that arrived after it
+        self.timed_out = OrderedDict()
+        self.dropped = 0
+        self.late = 0
+
+    def share(self):
+        """Return a caller for one analysis that sends reads on this connection
+
+        Each analysis sharing the connection gets its own called reads, window
+        cache and statistics, see SharedGuppyCaller.
+        """
+        if self._shared is None:
+            self._shared = _SharedConnection(self)
+        return SharedGuppyCaller(self._shared)
+
+    def _timeout(self, read_id):
+        self.dropped += 1
+        self.timed_out[read_id] = None
+        if len(self.timed_out) > self.MAX_TIMED_OUT:
+            self.timed_out.popitem(last=False)
+
+    def stats(self):
+        """Return a summary string of reads that missed the deadline"""
+        return "{} reads timed out, {} results arrived late".format(self.dropped, self.late)
+
+    def _stitch_called(self, channel, read_id, window, seq, qual):
+        """Join a windowed call onto the sequence cached for the read
+
+        `window` is (start, total) from `_create_guppy_read`, a call of the
+        whole read (start 0) replaces the cached sequence
+        """
+        start, samples = (0, 0) if window is None else window
+        prev = self.sequences.get(channel) if start > 0 else None
+        if prev is not None and prev[0] != read_id:
+            prev = None
+
+        if prev is not None:
+            _, prev_seq, prev_qual, prev_samples = prev
+            # Samples called in both the cached sequence and this window
+            overlap = max(prev_samples - start, 0)
+            cut = _stitch(prev_seq, seq, round(overlap * len(prev_seq) / max(prev_samples, 1)))
+            seq = prev_seq + seq[cut:]
+            qual = (prev_qual or "") + (qual or "")[cut:]
+
+        self.sequences[channel] = (read_id, seq, qual, samples)
+        return seq, qual
+
+    def _receive(self, hold, window_overlap, deadline, target=0):
+        """Yield called reads in `hold` as they are returned by the basecaller
 
-    def basecall_minknow(self, reads, signal_dtype, prev_signal, decided_reads):
+        Every result that is ready is taken, then polls with increasing sleeps
+        while more than `target` reads are held and `deadline` has not passed.
+        Results for reads not in `hold` are discarded.
+        """
+        backoff = self.BACKOFF_MIN
+        while hold:
+            res = self._get_called_read()
+
+            if res is None:
+                # Nothing ready, wait a little longer each time up to the deadline
+                if len(hold) <= target:
+                    return
+                now = timer()
+                if deadline is not None and now >= deadline:
+                    return
+                wait = backoff if deadline is None else min(backoff, deadline - now)
+                time.sleep(wait)
+                backoff = min(backoff * 2, self.BACKOFF_MAX)
+                continue
+            backoff = self.BACKOFF_MIN
+
+            read, called = res
+            if read.read_id in self.timed_out:
+                # A result for a read that already missed its deadline
+                del self.timed_out[read.read_id]
+                self.late += 1
+                continue
+            if read.read_id not in hold:
+                self.late += 1
+                continue
+            channel, read_number, window = hold.pop(read.read_id)
+            seq, seqlen, qual = called.seq, called.seqlen, called.qual
+            if window_overlap is not None:
+                seq, qual = self._stitch_called(channel, read.read_id, window, seq, qual)
+                seqlen = len(seq)
+
+            yield (channel, read_number), read.read_id, seq, seqlen, qual
+
+    def basecall_minknow(
+            self,
+            reads,
+            signal_dtype,
+            prev_signal,
+            decided_reads,
+            window_overlap=None,
+            timeout=None,
+            max_in_flight=None,
+            max_age=None,
+            prescreen=None,
+    ):
         """Guppy basecaller wrapper for MinKNOW RPC reads
 
         Parameters
@@ -73,63 +512,529 @@ class GuppyCaller(GuppyBasecallerClient):
             List or generator of tuples containing (channel, MinKNOW.rpc.Read)
         signal_dtype
             Numpy dtype of the raw data
-        prev_signal : DefaultDict[int: collections.deque[Tuple[str, np.ndarray]]]
-            Dictionary of previous signal fragment from a channel
-        decided_reads : Dict[int: str]
-            Dictionary of channels with the last read id a decision was made for
+        prev_signal : SignalStore
+            Signal seen so far for the current read on each channel
+        decided_reads : ru.state.ChannelState
+            Channel state, reads that a decision has been sent for are skipped
+        window_overlap : int, optional
+            If given, after the first chunk of a read only the newest chunk plus
+            this many samples before it are basecalled, and the new bases are
+            stitched onto the sequence called for the read so far
+        timeout : int or float, optional
+            Time, in seconds, to wait for the batch to be called. Reads that are
+            not called by then are yielded with sequence None and quality
+            BASECALL_TIMEOUT, and their results are discarded if they arrive
+            later. If not given, wait until every read is called
+        max_in_flight : int, optional
+            If given, results are collected while reads are still being
+            submitted, and no more than this many reads are sent to the
+            basecaller before their results are received. Called reads are
+            yielded as soon as they arrive. If not given, every read is
+            submitted before any results are collected
+        max_age : int or float, optional
+            If given, chunks that waited longer than this many seconds in the
+            read cache are not basecalled and are yielded with sequence None
+            and quality STALE
+        prescreen : ru.prescreen.PreScreen, optional
+            If given, chunks that match a pre-screen rule are not basecalled
+            and are yielded with sequence None and the rule's outcome as
+            quality
 
         Yields
         ------
         read_info : tuple
             Tuple of read info (channel, read_number)
         read_id : str
-        sequence : str
+        sequence : str or None
         sequence_length : int
         quality : str
         """
-        done = 0
-        read_counter = 0
+        deadline = None if timeout is None else timer() + timeout
+        reads, skipped = _screen(
+            reads, signal_dtype, prev_signal, decided_reads, max_age, prescreen
+        )
+        yield from skipped
 
         hold = {}
-        for channel, read_number, read in _create_guppy_read(
-            reads, signal_dtype, prev_signal
+        for channel, read_number, read, window in _create_guppy_read(
+            reads, signal_dtype, prev_signal, window_overlap
         ):
-            if read.read_id == decided_reads.get(channel, ""):
+            if decided_reads.is_decided(channel, read_number):
                 continue
 
-            hold[read.read_id] = (channel, read_number)
+            hold[read.read_id] = (channel, read_number, window)
             try:
                 self.pass_read(read)
             except Exception as e:
                 logger.warning("Skipping read: {} due to {}".format(read.read_id, e))
                 hold.pop(read.read_id)
                 continue
-            read_counter += 1
 
-        while done < read_counter:
-            res = self._get_called_read()
+            if max_in_flight is not None:
+                # Take any finished reads, blocking while the cap is reached
+                yield from self._receive(
+                    hold, window_overlap, deadline, target=max(max_in_flight - 1, 0)
+                )
 
-            if res is None:
+        yield from self._receive(hold, window_overlap, deadline)
+
+        for read_id, (channel, read_number, _) in hold.items():
+            self._timeout(read_id)
+            yield (channel, read_number), read_id, None, 0, BASECALL_TIMEOUT
+        if hold:
+            logger.debug("{} reads missed the basecall deadline".format(len(hold)))
+
+
+class _SharedConnection:
+    """Route the results from one basecaller connection to the reads' senders
+
+    Reads are sent, and results taken, under a lock. A result for a read sent
+    by another analysis is put on that analysis's inbox, so each analysis only
+    sees its own reads. Results for reads nobody sent are passed to the
+    analysis that took them, which counts them as late.
+    """
+
+    def __init__(self, caller):
+        self.caller = caller
+        self.lock = threading.Lock()
+        # {read_id: inbox of the analysis that sent it}
+        self.owners = {}
+
+    def pass_read(self, inbox, read):
+        with self.lock:
+            self.owners[read.read_id] = inbox
+            try:
+                self.caller.pass_read(read)
+            except Exception:
+                del self.owners[read.read_id]
+                raise
+
+    def get_called_read(self, inbox):
+        while True:
+            if inbox:
+                return inbox.popleft()
+            with self.lock:
+                res = self.caller._get_called_read()
+                if res is None:
+                    return None
+                owner = self.owners.pop(res[0].read_id, inbox)
+            if owner is inbox:
+                return res
+            owner.append(res)
+
+
+class SharedGuppyCaller(GuppyCaller):
+    """A GuppyCaller for one analysis using a connection shared with others
+
+    Created by `GuppyCaller.share`. Called reads are routed to the analysis
+    that sent them by read_id, so several analyses, for example on different
+    sequencing positions, can use one basecaller connection. `disconnect` is a
+    no-op, the connection is closed by its owner.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.inbox = deque()
+        self._init_results()
+
+    def pass_read(self, read):
+        self.connection.pass_read(self.inbox, read)
+
+    def _get_called_read(self):
+        return self.connection.get_called_read(self.inbox)
+
+    def share(self):
+        return SharedGuppyCaller(self.connection)
+
+    def disconnect(self):
+        pass
+
+
+class GuppyCallerPool:
+    """Spread basecalling over connections to several Guppy servers
+
+    Each read is sent to the server with the lowest expected wait, the number
+    of reads it has in flight scaled by its recent time per read. A server
+    that raises when sent a read, or that returns none of a batch before the
+    deadline, is taken out of rotation for `retry` seconds. Every connection
+    shares one cache of windowed calls so a channel's reads may move between
+    servers.
+
+    Parameters
+    ----------
+    servers : Sequence[str]
+        "host:port" of each Guppy server
+    retry : int or float
+        Time, in seconds, before a failed server is used again
+    kwargs
+        Passed to each GuppyCaller, e.g. config_name
+    """
+
+    # Weight given to the newest observation in the per-server latency
+    LATENCY_WEIGHT = 0.2
+
+    def __init__(self, servers, retry=30, **kwargs):
+        self.retry = retry
+        self.sequences = {}
+        self.callers = []
+        self.names = []
+        for server in servers:
+            host, port = server.rsplit(":", 1)
+            try:
+                caller = GuppyCaller(host=host, port=int(port), **kwargs)
+            except Exception as e:
+                logger.warning("Could not connect to basecall server {}: {}".format(server, e))
                 continue
+            caller.sequences = self.sequences
+            self.callers.append(caller)
+            self.names.append(server)
+        if not self.callers:
+            raise ConnectionError("Could not connect to any basecall server")
+        n = len(self.callers)
+        self.latency = np.full(n, 0.01)
+        self.called = np.zeros(n, dtype=np.int64)
+        self.down_until = np.zeros(n)
 
-            read, called = res
+    def _available(self):
+        """Indices of servers in rotation, every server if all have failed"""
+        up = np.flatnonzero(self.down_until <= timer())
+        return up if len(up) else np.arange(len(self.callers))
+
+    def _take_down(self, i, reason):
+        self.down_until[i] = timer() + self.retry
+        logger.warning(
+            "Basecall server {} out of rotation for {}s: {}".format(self.names[i], self.retry, reason)
+        )
 
-            yield hold.pop(
-                read.read_id
-            ), read.read_id, called.seq, called.seqlen, called.qual
-            done += 1
+    def basecall_minknow(
+            self,
+            reads,
+            signal_dtype,
+            prev_signal,
+            decided_reads,
+            window_overlap=None,
+            timeout=None,
+            max_in_flight=None,
+            max_age=None,
+            prescreen=None,
+    ):
+        """Basecall reads across the pool, see GuppyCaller.basecall_minknow
+
+        `max_in_flight` applies to each server. Results are collected from
+        every server while reads are submitted if it is given, otherwise once
+        the whole batch is submitted.
+        """
+        deadline = None if timeout is None else timer() + timeout
+        reads, skipped = _screen(
+            reads, signal_dtype, prev_signal, decided_reads, max_age, prescreen
+        )
+        yield from skipped
+
+        holds = [{} for _ in self.callers]
+        returned = [0] * len(self.callers)
+        sent = {}
+        up = self._available()
+
+        def receive(i, target):
+            for res in self.callers[i]._receive(holds[i], window_overlap, deadline, target):
+                t = sent.pop(res[1])
+                self.latency[i] += self.LATENCY_WEIGHT * (timer() - t - self.latency[i])
+                self.called[i] += 1
+                returned[i] += 1
+                yield res
+
+        for channel, read_number, read, window in _create_guppy_read(
+            reads, signal_dtype, prev_signal, window_overlap
+        ):
+            if decided_reads.is_decided(channel, read_number):
+                continue
+
+            load = [(len(holds[i]) + 1) * self.latency[i] for i in up]
+            i = up[int(np.argmin(load))]
+            holds[i][read.read_id] = (channel, read_number, window)
+            try:
+                self.callers[i].pass_read(read)
+            except Exception as e:
+                logger.warning("Skipping read: {} due to {}".format(read.read_id, e))
+                holds[i].pop(read.read_id)
+                self._take_down(i, e)
+                up = self._available()
+                continue
+            sent[read.read_id] = timer()
+
+            if max_in_flight is not None:
+                yield from receive(i, max(max_in_flight - 1, 0))
+
+        # Drain every server without blocking, then sleep briefly if none had results
+        backoff = GuppyCaller.BACKOFF_MIN
+        while any(holds):
+            n = len(sent)
+            for i, hold in enumerate(holds):
+                if hold:
+                    yield from receive(i, len(hold))
+            if len(sent) < n:
+                backoff = GuppyCaller.BACKOFF_MIN
+                continue
+            now = timer()
+            if deadline is not None and now >= deadline:
+                break
+            time.sleep(backoff if deadline is None else min(backoff, deadline - now))
+            backoff = min(backoff * 2, GuppyCaller.BACKOFF_MAX)
+
+        for i, hold in enumerate(holds):
+            if not hold:
+                continue
+            if not returned[i]:
+                self._take_down(i, "no reads returned before the deadline")
+            for read_id, (channel, read_number, _) in hold.items():
+                self.callers[i]._timeout(read_id)
+                yield (channel, read_number), read_id, None, 0, BASECALL_TIMEOUT
+
+    def stats(self):
+        """Return a summary string of each server"""
+        return "; ".join(
+            "{} {} reads, {:.1f}ms/read, {}".format(
+                name, called, latency * 1000, caller.stats()
+            )
+            for name, caller, called, latency in zip(
+                self.names, self.callers, self.called, self.latency
+            )
+        )
+
+    def share(self):
+        """Return a pool for one analysis that sends reads on these connections
+
+        Server latency, rotation and the window cache are kept per analysis,
+        see GuppyCaller.share.
+        """
+        pool = copy.copy(self)
+        pool.sequences = {}
+        pool.callers = [caller.share() for caller in self.callers]
+        for caller in pool.callers:
+            caller.sequences = pool.sequences
+        pool.latency = self.latency.copy()
+        pool.called = np.zeros_like(self.called)
+        pool.down_until = self.down_until.copy()
+        return pool
+
+    def disconnect(self):
+        for caller in self.callers:
+            caller.disconnect()
+
+
+def get_caller(caller_settings):
+    """Connect to the basecaller(s) given by the `caller_settings` TOML table
+
+    Returns a GuppyCallerPool if `servers` is given, otherwise a GuppyCaller
+    """
+    settings = dict(caller_settings)
+    servers = settings.pop("servers", None)
+    retry = settings.pop("server_retry", 30)
+    if servers is None:
+        return GuppyCaller(**settings)
+    settings.pop("host", None)
+    settings.pop("port", None)
+    return GuppyCallerPool(servers, retry=retry, **settings)
+
+
+def _result(outcome):
+    # The alignments of a mapped call, or the outcome of one that was not mapped
+    return outcome.result() if isinstance(outcome, Future) else outcome
 
 
 class Mapper:
-    def __init__(self, index):
+    """Wrapper around mappy.Aligner
+
+    Parameters
+    ----------
+    index : str
+        Path to a minimap2 index or FASTA file, if falsy no mapper is loaded
+    threads : int
+        Number of threads `map_reads_2` uses to map each batch
+    cache : bool or str
+        If truthy, FASTA references are indexed once and the index is reused
+        from the cache on later runs, see ru.index.cached_index. A string is
+        the cache directory to use.
+    server : str, optional
+        Path of a map server's socket, see ru.map_server. If given, reads are
+        mapped by the server rather than loading the index in this process
+
+    Attributes
+    ----------
+    index_file : str or None
+        The file the index was loaded from, the cached index for a FASTA
+    retired : bool
+        Set when every analysis sharing the mapper has replaced it, it is
+        closed once no batch is using it, see `share` and `use`
+    """
+
+    def __init__(self, index, threads=1, cache=True, server=None):
         self.index = index
-        if self.index:
-            self.mapper = mp.Aligner(self.index, preset="map-ont")
+        self.index_file = index
+        self.threads = threads
+        self._pools = {}
+        self._local = threading.local()
+        self._users = 0
+        self._users_lock = threading.Lock()
+        self._owners = 0
+        self.retired = False
+        self.remote = server is not None
+        if self.index and self.remote:
+            self.mapper = MapClient(server)
+            if Path(self.mapper.reference).resolve() != Path(self.index).resolve():
+                self.mapper.close()
+                raise ValueError(
+                    "Map server {} serves {}, not {}".format(server, self.mapper.reference, self.index)
+                )
+            self.initialised = True
+        elif self.index:
+            if cache:
+                try:
+                    self.index_file = cached_index(
+                        self.index, cache=None if cache is True else cache
+                    )
+                except OSError as e:
+                    logger.warning("Not caching index for {}: {}".format(self.index, e))
+            self.mapper = mp.Aligner(self.index_file, preset=DEFAULT_PRESET)
             self.initialised = True
         else:
             self.mapper = None
             self.initialised = False
 
+    def _map_buffered(self, seq):
+        # mappy releases the GIL while mapping, each thread needs its own buffer
+        buf = getattr(self._local, "buf", None)
+        if buf is None:
+            buf = self._local.buf = mp.ThreadBuffer()
+        return list(self.mapper.map(seq, buf=buf))
+
+    def map_batch(self, seqs, threads=None):
+        """Map a batch of sequences, spread over a pool of threads
+
+        Parameters
+        ----------
+        seqs : Sequence[str]
+            Sequences to map
+        threads : int, optional
+            Number of threads to use, defaults to the `threads` given to Mapper
+
+        Returns
+        -------
+        list
+            List of mapping results for each sequence, in input order
+        """
+        if self.remote:
+            return self.mapper.map_batch(seqs)
+        threads = self.threads if threads is None else threads
+        if threads <= 1 or len(seqs) < 2:
+            return [list(self.mapper.map(seq)) for seq in seqs]
+        return list(self._pool(threads).map(self._map_buffered, seqs))
+
+    def _pool(self, threads):
+        with self._users_lock:
+            # Shared by every analysis using this mapper
+            pool = self._pools.get(threads)
+            if pool is None:
+                pool = self._pools[threads] = ThreadPoolExecutor(
+                    max_workers=threads, thread_name_prefix="mapper"
+                )
+        return pool
+
+    def _remote_submitter(self):
+        """Return a function that queues a sequence to map on the map server
+
+        The first sequence is sent on its own; sequences queued while a
+        request is in flight are sent together as the next request. Each call
+        returns a Future of the sequence's alignments.
+        """
+        lock = threading.Lock()
+        waiting = []
+        sending = [False]
+
+        def send():
+            while True:
+                with lock:
+                    batch = waiting[:]
+                    del waiting[:]
+                    if not batch:
+                        sending[0] = False
+                        return
+                try:
+                    mapped = self.mapper.map_batch([seq for seq, _ in batch])
+                except Exception as e:
+                    for _, result in batch:
+                        result.set_exception(e)
+                    continue
+                for (_, result), alignments in zip(batch, mapped):
+                    result.set_result(alignments)
+
+        def submit(seq):
+            result = Future()
+            with lock:
+                waiting.append((seq, result))
+                start = not sending[0]
+                sending[0] = True
+            if start:
+                threading.Thread(target=send, name="map-client", daemon=True).start()
+            return result
+
+        return submit
+
+    def close(self):
+        """Shut down any mapping threads"""
+        for pool in self._pools.values():
+            pool.shutdown(wait=False)
+        self._pools = {}
+        if self.remote and self.mapper is not None:
+            self.mapper.close()
+
+    @contextmanager
+    def use(self):
+        """Mark the mapper as in use for the duration of a batch
+
+        Callers should check `retired` after entering and switch to the
+        replacement mapper if it is set; a retired mapper is only freed once
+        `busy` is False.
+        """
+        with self._users_lock:
+            self._users += 1
+        try:
+            yield self
+        finally:
+            with self._users_lock:
+                self._users -= 1
+
+    def share(self):
+        """Register an analysis that uses the mapper, returns the mapper"""
+        with self._users_lock:
+            self._owners += 1
+        return self
+
+    def retire(self):
+        """Deregister an analysis that has replaced the mapper
+
+        Returns
+        -------
+        bool
+            True if no analysis uses the mapper any more, it is then marked
+            `retired` and should be freed once it is not `busy`
+        """
+        with self._users_lock:
+            self._owners -= 1
+            if self._owners <= 0:
+                self.retired = True
+        return self.retired
+
+    def busy(self):
+        """Return True if any batch is using the mapper"""
+        return self._users > 0
+
+    def free(self):
+        """Close the mapper and release its index"""
+        self.close()
+        self.mapper = None
+        self.initialised = False
+
     def map_read(self, seq):
         return self.mapper.map(seq)
 
@@ -137,13 +1042,16 @@ class Mapper:
         for read_id, seq in calls:
             yield read_id, list(self.mapper.map(seq))
 
-    def map_reads_2(self, calls):
+    def map_reads_2(self, calls, min_seq_len=None):
         """Align reads against a reference
 
         Parameters
         ----------
         calls : iterable [tuple,  str, str, int, str]
             An iterable of called reads from PerpetualCaller.basecall_minknow
+        min_seq_len : np.ndarray, optional
+            Minimum sequence length to map, indexed by channel. Shorter calls,
+            and empty calls, are not mapped and are given NO_SEQ
 
         Yields
         ------
@@ -152,7 +1060,44 @@ class Mapper:
         read_id : str
         sequence : str
         sequence_length : int
-        mapping_results : list
+        mapping_results : list or str
+            Alignments, or for reads that were not basecalled (sequence is
+            None) the outcome given by the basecaller, e.g. BASECALL_TIMEOUT,
+            or NO_SEQ for calls that were too short to map
         """
+
+        def skip(read_info, seq, seq_len, quality):
+            # The outcome for a call that is not mapped, None to map it
+            if seq is None:
+                return quality
+            if not seq_len or (min_seq_len is not None and seq_len < min_seq_len[read_info[0]]):
+                return NO_SEQ
+            return None
+
+        if self.threads > 1 or self.remote:
+            # Calls are mapped as they arrive and yielded in order once mapped
+            if self.remote:
+                submit = self._remote_submitter()
+            else:
+                pool = self._pool(self.threads)
+
+                def submit(seq):
+                    return pool.submit(self._map_buffered, seq)
+
+            held = deque()
+            for read_info, read_id, seq, seq_len, quality in calls:
+                outcome = skip(read_info, seq, seq_len, quality)
+                held.append((read_info, read_id, seq_len, submit(seq) if outcome is None else outcome))
+                while held and (not isinstance(held[0][3], Future) or held[0][3].done()):
+                    read_info, read_id, seq_len, outcome = held.popleft()
+                    yield read_info, read_id, seq_len, _result(outcome)
+            for read_info, read_id, seq_len, outcome in held:
+                yield read_info, read_id, seq_len, _result(outcome)
+            return
+
         for read_info, read_id, seq, seq_len, quality in calls:
-            yield read_info, read_id, seq_len, list(self.mapper.map(seq))
+            outcome = skip(read_info, seq, seq_len, quality)
+            if outcome is None:
+                yield read_info, read_id, seq_len, list(self.mapper.map(seq))
+            else:
+                yield read_info, read_id, seq_len, outcome
@@ -0,0 +1,227 @@
+"""classify.py
+
+Batch classification of mapped reads into modes and decisions
+
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from ru.utils import Decision, MODES, MODE_INDEX
+
+
+__all__ = ["OUTCOMES", "BatchDecisions", "classify_batch", "read_info_arrays"]
+
+# Every mode a read can be given. The first len(MODES) take their action from
+#  the condition table in the ExperimentPlan, the rest are fixed outcomes.
+OUTCOMES = MODES + (
+    "control",
+    "exceeded_max_chunks_unblocked",
+    "below_min_chunks_unblocked",
+    "basecall_timeout",
+    "stale",
+    "prescreen_short",
+    "prescreen_flat",
+    "prescreen_saturated",
+    "prescreen_stall",
+)
+OUTCOME_INDEX = {m: i for i, m in enumerate(OUTCOMES)}
+
+SINGLE_ON = OUTCOME_INDEX["single_on"]
+SINGLE_OFF = OUTCOME_INDEX["single_off"]
+MULTI_ON = OUTCOME_INDEX["multi_on"]
+MULTI_OFF = OUTCOME_INDEX["multi_off"]
+NO_MAP = OUTCOME_INDEX["no_map"]
+CONTROL = OUTCOME_INDEX["control"]
+EXCEEDED = OUTCOME_INDEX["exceeded_max_chunks_unblocked"]
+BELOW = OUTCOME_INDEX["below_min_chunks_unblocked"]
+BASECALL_TIMEOUT = OUTCOME_INDEX["basecall_timeout"]
+STALE = OUTCOME_INDEX["stale"]
+
+# Action for reads given an outcome in place of mapping results, these reads
+#  have no data to decide on, or the read has likely ended, so are left to
+#  sequence until the next chunk unless classify_batch is given other actions
+_FIXED_ACTIONS = {
+    i: Decision.PROCEED for i in range(BASECALL_TIMEOUT, len(OUTCOMES))
+}
+
+# Modes that mean the read mapped somewhere
+_MAPPED = np.array([SINGLE_ON, SINGLE_OFF, MULTI_ON, MULTI_OFF])
+_STRANDS = {1: 0, -1: 1}
+_STRAND_NAMES = ("+", "-")
+
+BatchDecisions = namedtuple(
+    "BatchDecisions",
+    [
+        "channels",
+        "read_numbers",
+        "conditions",
+        "modes",
+        "actions",
+        "decided",
+        "below",
+        "exceeded",
+    ],
+)
+
+
+def read_info_arrays(batch):
+    """Return arrays of the channel and read number of each read in a batch"""
+    n = len(batch)
+    channels = np.fromiter((b[0][0] for b in batch), dtype=np.intp, count=n)
+    read_numbers = np.fromiter((b[0][1] for b in batch), dtype=np.int64, count=n)
+    return channels, read_numbers
+
+
+def _pack_hits(batch):
+    """Flatten the mapping results of a batch into arrays
+
+    Parameters
+    ----------
+    batch : list
+        List of (read_info, read_id, seq_len, results) from Mapper.map_reads_2
+
+    Returns
+    -------
+    offsets : np.ndarray
+        Start of each read's hits, length len(batch) + 1
+    contigs : list
+        Contig names, indexed by the ids in `ctg_ids`
+    ctg_ids : np.ndarray
+        Contig id of each hit
+    strands : np.ndarray
+        0 for forward and 1 for reverse strand hits
+    r_st : np.ndarray
+        Reference start of each hit
+    """
+    vocab = {}
+    ctg_ids, strands, r_st = [], [], []
+    offsets = np.zeros(len(batch) + 1, dtype=np.intp)
+    for i, (_, _, _, results) in enumerate(batch, start=1):
+        if isinstance(results, str):
+            offsets[i] = len(ctg_ids)
+            continue
+        for r in results:
+            ctg_ids.append(vocab.setdefault(r.ctg, len(vocab)))
+            strands.append(_STRANDS[r.strand])
+            r_st.append(r.r_st)
+        offsets[i] = len(ctg_ids)
+    return (
+        offsets,
+        list(vocab),
+        np.array(ctg_ids, dtype=np.intp),
+        np.array(strands, dtype=np.intp),
+        np.array(r_st, dtype=np.int64),
+    )
+
+
+def classify_batch(batch, counts, plan, fixed_actions=None):
+    """Classify a batch of mapped reads in a single vectorised pass
+
+    Parameters
+    ----------
+    batch : list
+        List of (read_info, read_id, seq_len, results) from Mapper.map_reads_2
+        where read_info is (channel, read_number). Reads whose results are a
+        mode name, e.g. "no_seq", take the condition's action for that mode and
+        those with another outcome, e.g. "basecall_timeout", a fixed action
+    counts : Sequence[int]
+        The number of chunks seen for each read in `batch`
+    plan : ru.utils.ExperimentPlan
+        The compiled experimental conditions
+    fixed_actions : dict, optional
+        {outcome name: Decision} overriding the action for reads given an
+        outcome, e.g. ru.prescreen.PreScreen.actions
+
+    Returns
+    -------
+    BatchDecisions
+        Arrays, one element per read, of the channel, read number, condition,
+        mode (index into OUTCOMES), action (Decision code), whether the read
+        should be recorded as decided and the min/max chunk flags
+    """
+    n = len(batch)
+    channels, read_numbers = read_info_arrays(batch)
+    counts = np.asarray(counts, dtype=float)
+    conditions = plan.condition[channels]
+
+    offsets, contigs, ctg_ids, strands, r_st = _pack_hits(batch)
+    n_hits = np.diff(offsets)
+    read_idx = np.repeat(np.arange(n), n_hits)
+    hit_conds = conditions[read_idx]
+
+    # Number of distinct contigs each read maps to
+    n_ctg = max(len(contigs), 1)
+    uniq = np.unique(read_idx * n_ctg + ctg_ids)
+    n_unique = np.bincount(uniq // n_ctg, minlength=n)
+
+    # Per condition lookups for the contigs in this batch, then per hit checks
+    on_target = np.zeros(len(ctg_ids), dtype=bool)
+    coord_hit = np.zeros(len(ctg_ids), dtype=bool)
+    for c in np.unique(hit_conds[hit_conds >= 0]):
+        condition = plan.conditions[c]
+        mask = hit_conds == c
+        is_target = np.array([ctg in condition.targets for ctg in contigs], dtype=bool)
+        groups = np.array(
+            [
+                [condition.coord_index.group(s, ctg) for ctg in contigs]
+                for s in _STRAND_NAMES
+            ],
+            dtype=np.int64,
+        )
+        on_target[mask] = is_target[ctg_ids[mask]]
+        coord_hit[mask] = condition.coord_index.contains_many(
+            groups[strands[mask], ctg_ids[mask]], r_st[mask]
+        )
+
+    any_target = np.bincount(read_idx, weights=on_target, minlength=n) > 0
+    coord_match = np.bincount(read_idx, weights=coord_hit, minlength=n) > 0
+    on = any_target & coord_match
+
+    modes = np.full(n, NO_MAP, dtype=np.intp)
+    modes[(n_unique == 1) & on] = SINGLE_ON
+    modes[(n_unique == 1) & ~on] = SINGLE_OFF
+    modes[(n_unique > 1) & on] = MULTI_ON
+    modes[(n_unique > 1) & ~on] = MULTI_OFF
+
+    # Action configured for each mode by each read's condition
+    actions = plan.actions[modes, np.maximum(conditions, 0)].astype(np.int8)
+
+    # Reads that were not mapped because of an earlier failure
+    fixed = np.zeros(n, dtype=bool)
+    for i, (_, _, _, results) in enumerate(batch):
+        if isinstance(results, str):
+            modes[i] = OUTCOME_INDEX[results]
+            if results in MODE_INDEX:
+                actions[i] = plan.actions[modes[i], max(conditions[i], 0)]
+                continue
+            if fixed_actions is not None and results in fixed_actions:
+                actions[i] = fixed_actions[results]
+            else:
+                actions[i] = _FIXED_ACTIONS[modes[i]]
+            fixed[i] = True
+    decided = actions != Decision.PROCEED
+
+    control = plan.control[channels]
+    below = (counts <= plan.min_chunks[channels]) & ~control
+    exceeded = (counts >= plan.max_chunks[channels]) & ~control & ~fixed
+
+    # If max_chunks has been exceeded AND we don't want to keep sequencing we unblock
+    mask = exceeded & (actions != Decision.STOP_RECEIVING)
+    modes[mask] = EXCEEDED
+    actions[mask] = Decision.UNBLOCK
+
+    # If under min_chunks AND any mapping mode seen we unblock
+    mask = below & np.isin(modes, _MAPPED)
+    modes[mask] = BELOW
+    actions[mask] = Decision.UNBLOCK
+    decided[mask] = False
+
+    # Control channels are never analysed
+    modes[control] = CONTROL
+    actions[control] = Decision.STOP_RECEIVING
+    decided[control] = False
+
+    return BatchDecisions(
+        channels, read_numbers, conditions, modes, actions, decided, below, exceeded
+    )
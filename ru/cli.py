@@ -19,7 +19,9 @@ def main():
         ("centrifuge", "iteralign_centrifuge"),
         ("unblock-all", "unblock_all"),
         ("validate", "validate"),
-        ("summary", "summarise_fq")
+        ("summary", "summarise_fq"),
+        ("index", "index"),
+        ("map-server", "map_server"),
     ]
     for cmd, module in cmds:
         _module = importlib.import_module("ru.{}".format(module))
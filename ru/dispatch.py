@@ -0,0 +1,412 @@
+"""dispatch.py
+
+Route read chunks from one ReadUntilClient to several analysis workers, threads
+or forked processes, so that every chunk from a channel is always handled by the
+same worker
+
+"""
+import logging
+import multiprocessing
+import queue
+import threading
+from collections import OrderedDict, namedtuple
+from timeit import default_timer as timer
+
+from ru.actions import ActionBuffer
+from ru.read_cache import ReceivedChunk, wait_for_chunks
+from ru.utils import send_message
+
+
+__all__ = ["ChannelDispatcher", "ChannelRoutedClient", "ProcessDispatcher"]
+
+logger = logging.getLogger("RU_dispatch")
+
+
+class ChannelDispatcher:
+    """Pull read chunks once and hand each channel to a fixed worker
+
+    Each analysis worker keeps its own signal, chunk count and decision state.
+    If the workers all called `get_read_chunks` on the client, successive
+    chunks of a read could be handled by different workers and that state
+    would silently restart. The dispatcher runs a single thread that pulls
+    chunks from the client and files them by `channel % n_workers`; each
+    worker is given a `ChannelRoutedClient` that only returns chunks from its
+    own channels, so workers own disjoint state and need no locks.
+
+    As with the client's read cache, only the most recent chunk for a channel
+    is held.
+
+    Parameters
+    ----------
+    client : read_until.ReadUntilClient
+        An instance of the ReadUntilClient object
+    n_workers : int
+        The number of analysis workers to route chunks to
+    batch_size : int
+        The number of reads to be retrieved from the ReadUntilClient at a time
+    throttle : int or float
+        The number of seconds interval between requests to the ReadUntilClient
+    """
+
+    def __init__(self, client, n_workers, batch_size=512, throttle=0.1):
+        self.client = client
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        self.throttle = throttle
+        self.shards = [OrderedDict() for _ in range(n_workers)]
+        self.locks = [threading.Condition() for _ in range(n_workers)]
+        self.routed = [0] * n_workers
+        self._thread = None
+
+    def shard(self, channel):
+        """Return the worker index that owns `channel`"""
+        return channel % self.n_workers
+
+    def client_for(self, shard):
+        """Return a client proxy for one worker"""
+        return ChannelRoutedClient(self.client, self, shard)
+
+    def start(self):
+        """Start pulling chunks from the client on a background thread"""
+        self._thread = threading.Thread(target=self._run, name="ChannelDispatcher", daemon=True)
+        self._thread.start()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while self.client.is_running:
+            t0 = timer()
+            self.route(self.client.get_read_chunks(batch_size=self.batch_size, last=True))
+            t1 = timer()
+            if t0 + self.throttle > t1:
+                wait_for_chunks(self.client, self.throttle + t0 - t1)
+        logger.info(
+            "Dispatcher stopped, chunks routed per worker: {}".format(self.routed)
+        )
+
+    def route(self, chunks):
+        """File (channel, read) chunks under the worker that owns each channel"""
+        for chunk in chunks:
+            channel = chunk[0]
+            i = self.shard(channel)
+            with self.locks[i]:
+                shard = self.shards[i]
+                # The whole chunk is kept as it may carry a receive time
+                shard[channel] = chunk
+                shard.move_to_end(channel)
+                self.locks[i].notify_all()
+            self.routed[i] += 1
+
+    def get_read_chunks(self, shard, batch_size=1, last=True):
+        """Pop up to `batch_size` chunks belonging to one worker
+
+        Parameters
+        ----------
+        shard : int
+            The worker index
+        batch_size : int
+            Maximum number of chunks to return
+        last : bool
+            If True the most recently updated channels are returned first
+
+        Returns
+        -------
+        list
+            List of (channel, read) tuples
+        """
+        with self.locks[shard]:
+            items = self.shards[shard]
+            return [
+                items.popitem(last=last)[1] for _ in range(min(batch_size, len(items)))
+            ]
+
+    def wait(self, shard, timeout):
+        """Block until one worker has chunks or `timeout` seconds pass"""
+        with self.locks[shard]:
+            return self.locks[shard].wait_for(lambda: len(self.shards[shard]) > 0, timeout)
+
+
+class ChannelRoutedClient:
+    """ReadUntilClient proxy that only returns one worker's channels
+
+    All attributes other than `get_read_chunks` are taken from the wrapped
+    client, so actions are still sent directly.
+    """
+
+    def __init__(self, client, dispatcher, shard):
+        self.client = client
+        self.dispatcher = dispatcher
+        self.shard = shard
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def get_read_chunks(self, batch_size=1, last=True):
+        return self.dispatcher.get_read_chunks(self.shard, batch_size=batch_size, last=last)
+
+    def wait_for_chunks(self, timeout):
+        return self.dispatcher.wait(self.shard, timeout)
+
+
+class _Log:
+    """Stands in for `client.connection.log` in a worker process"""
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+
+    def send_user_message(self, severity, user_message):
+        self.outbox.put(("message", severity, user_message))
+
+
+class _Connection:
+    """Stands in for `client.connection` in a worker process"""
+
+    def __init__(self, outbox):
+        self.log = _Log(outbox)
+
+
+Chunk = namedtuple("Chunk", ["id", "number", "raw_data", "received"])
+
+
+class ProcessShardClient:
+    """ReadUntilClient stand-in used inside a worker process
+
+    Chunks arrive from the parent process on `inbox` as lists of
+    (channel, Chunk). Actions and user messages are queued on `outbox` for the
+    parent to send; actions are held until `flush_actions` is called, which
+    `ru.actions.ActionBuffer` does at the end of every flush.
+
+    Parameters
+    ----------
+    shard : int
+        The worker index
+    inbox : multiprocessing.Queue
+        Chunks from the parent, None stops the worker
+    outbox : multiprocessing.Queue
+        Actions and messages to the parent
+    signal_dtype : np.dtype
+        The ReadUntilClient signal_dtype
+    mk_run_dir : pathlib.Path
+        The ReadUntilClient mk_run_dir
+    throttle : int or float
+        Maximum time, in seconds, to wait for chunks in `get_read_chunks`
+    """
+
+    def __init__(self, shard, inbox, outbox, signal_dtype, mk_run_dir, throttle=0.1):
+        self.shard = shard
+        self.inbox = inbox
+        self.outbox = outbox
+        self.signal_dtype = signal_dtype
+        self.mk_run_dir = mk_run_dir
+        self.throttle = throttle
+        self.connection = _Connection(outbox)
+        self.is_running = True
+        self.unblocks = []
+        self.stops = []
+        self.duration = 0.1
+
+    def get_read_chunks(self, batch_size=1, last=True):
+        try:
+            chunks = self.inbox.get(timeout=self.throttle)
+        except queue.Empty:
+            return []
+        if chunks is None:
+            self.is_running = False
+            return []
+        # The router sends at most one batch at a time, return all of it
+        return [ReceivedChunk((channel, chunk), chunk.received) for channel, chunk in chunks]
+
+    def wait_for_chunks(self, timeout):
+        # get_read_chunks already blocks until the parent sends chunks
+        return True
+
+    def unblock_read(self, read_channel, read_number, duration=0.1, read_id=None):
+        self.duration = duration
+        self.unblocks.append((read_channel, read_number, read_id))
+
+    def stop_receiving_read(self, read_channel, read_number):
+        self.stops.append((read_channel, read_number))
+
+    def flush_actions(self):
+        """Send held actions to the parent process in one message"""
+        if self.unblocks or self.stops:
+            self.outbox.put(("actions", self.unblocks, self.stops, self.duration))
+            self.unblocks, self.stops = [], []
+
+
+def _reopen_file_logs(suffix):
+    """Point every FileHandler at its own file in a worker process
+
+    Handlers inherited through fork share file offsets with the parent and the
+    other workers, so each worker writes to `<log file>.<suffix>` instead.
+    """
+    loggers = [logging.getLogger()] + [
+        lg for lg in logging.Logger.manager.loggerDict.values() if isinstance(lg, logging.Logger)
+    ]
+    for lg in loggers:
+        for handler in list(lg.handlers):
+            if isinstance(handler, logging.FileHandler):
+                new = logging.FileHandler("{}.{}".format(handler.baseFilename, suffix), mode="w")
+                new.setFormatter(handler.formatter)
+                new.setLevel(handler.level)
+                lg.removeHandler(handler)
+                lg.addHandler(new)
+
+
+def _process_worker(shard, analysis_worker, inbox, outbox, throttle):
+    """Entry point for a forked worker process"""
+    _reopen_file_logs(shard)
+    init = inbox.get()
+    if init is not None:
+        client = ProcessShardClient(shard, inbox, outbox, throttle=throttle, **init)
+        try:
+            analysis_worker(client=client)
+        except Exception as e:
+            logger.exception("Worker {} raised an exception".format(shard), exc_info=e)
+        client.flush_actions()
+    outbox.put(("done", shard, None, None))
+
+
+class ProcessDispatcher:
+    """Run analysis workers in forked processes, each owning a channel shard
+
+    The worker processes are forked by `start`, which should be called once the
+    minimap2 index is loaded and before the ReadUntilClient is created, so that
+    every worker reads the index through copy-on-write memory and no gRPC
+    threads are forked. The parent then only talks to the ReadUntilClient: a
+    router thread pulls chunks and sends each worker the channels it owns, and
+    a sender thread sends the actions the workers return.
+
+    Parameters
+    ----------
+    analysis_worker : partial function
+        Analysis function, called in each worker as `analysis_worker(client=...)`
+    n_workers : int
+        Number of worker processes
+    batch_size : int
+        The number of reads to be retrieved from the ReadUntilClient at a time
+    throttle : int or float
+        The number of seconds interval between requests to the ReadUntilClient
+    """
+
+    def __init__(self, analysis_worker, n_workers, batch_size=512, throttle=0.1):
+        self.analysis_worker = analysis_worker
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        self.throttle = throttle
+        self.client = None
+        self.processes = []
+        self.threads = []
+        self.pending = [OrderedDict() for _ in range(n_workers)]
+        self.sent = [0] * n_workers
+        ctx = multiprocessing.get_context("fork")
+        # At most one batch waits for a worker, newer chunks are held and merged
+        #  by channel in `pending` until the worker has taken it
+        self.inboxes = [ctx.Queue(maxsize=2) for _ in range(n_workers)]
+        self.outbox = ctx.Queue()
+        self._ctx = ctx
+
+    def shard(self, channel):
+        """Return the worker index that owns `channel`"""
+        return channel % self.n_workers
+
+    def start(self):
+        """Fork the worker processes"""
+        for i in range(self.n_workers):
+            p = self._ctx.Process(
+                target=_process_worker,
+                args=(i, self.analysis_worker, self.inboxes[i], self.outbox, self.throttle),
+                name="ReadFishShard-{}".format(i),
+                daemon=True,
+            )
+            p.start()
+            self.processes.append(p)
+        logger.info("Started {} worker processes".format(self.n_workers))
+
+    def attach(self, client, unblock_duration=0.1):
+        """Hand the running ReadUntilClient to the workers and start routing
+
+        Parameters
+        ----------
+        client : read_until.ReadUntilClient
+            A running instance of the ReadUntilClient object
+        unblock_duration : int or float
+            Time, in seconds, to apply unblock voltage
+        """
+        self.client = client
+        self.actions = ActionBuffer(client, unblock_duration=unblock_duration)
+        init = {"signal_dtype": client.signal_dtype, "mk_run_dir": client.mk_run_dir}
+        for inbox in self.inboxes:
+            inbox.put(init)
+        self.threads = [
+            threading.Thread(target=self._route, name="ShardRouter", daemon=True),
+            threading.Thread(target=self._send, name="ShardSender", daemon=True),
+        ]
+        for t in self.threads:
+            t.start()
+
+    def _route(self):
+        while self.client.is_running:
+            t0 = timer()
+            for chunk in self.client.get_read_chunks(batch_size=self.batch_size, last=True):
+                channel, read = chunk
+                pending = self.pending[self.shard(channel)]
+                pending[channel] = Chunk(
+                    read.id, read.number, read.raw_data, getattr(chunk, "received", None)
+                )
+                pending.move_to_end(channel)
+            for i, pending in enumerate(self.pending):
+                if pending and self.inboxes[i].empty():
+                    # Most recently updated channels first, as `last=True`. At
+                    #  most one batch is sent, the rest wait for the next round
+                    batch = [
+                        pending.popitem(last=True)
+                        for _ in range(min(self.batch_size, len(pending)))
+                    ]
+                    self.inboxes[i].put(batch)
+                    self.sent[i] += len(batch)
+            t1 = timer()
+            if t0 + self.throttle > t1:
+                wait_for_chunks(self.client, self.throttle + t0 - t1)
+        logger.info("Shard router stopped, chunks sent per worker: {}".format(self.sent))
+
+    def _send(self):
+        done = 0
+        while done < self.n_workers:
+            try:
+                kind, *payload = self.outbox.get(timeout=1)
+            except queue.Empty:
+                if not any(p.is_alive() for p in self.processes):
+                    break
+                continue
+            if kind == "actions":
+                unblocks, stops, duration = payload
+                self.actions.unblock_duration = duration
+                for channel, read_number, read_id in unblocks:
+                    self.actions.unblock(channel, read_number, read_id)
+                for channel, read_number in stops:
+                    self.actions.stop_receiving(channel, read_number)
+                self.actions.flush()
+            elif kind == "message":
+                severity, message = payload
+                send_message(self.client.connection, message, severity)
+            elif kind == "done":
+                done += 1
+        logger.info("Shard sender stopped, sent {}".format(self.actions.stats()))
+
+    def stop(self, timeout=3):
+        """Stop the workers once the client has stopped"""
+        for inbox in self.inboxes:
+            try:
+                inbox.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        for t in self.threads:
+            t.join(timeout)
+        for p in self.processes:
+            p.join(timeout)
+            if p.is_alive():
+                logger.warning("Worker process {} did not exit, terminating".format(p.name))
+                p.terminate()
@@ -0,0 +1,200 @@
+"""index.py
+
+Content addressed cache of minimap2 indexes built from FASTA references
+
+"""
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import mappy as mp
+import toml
+
+
+__all__ = ["cache_dir", "cached_index", "index_key", "is_index", "reference_path", "DEFAULT_PRESET"]
+
+logger = logging.getLogger("RU_index")
+
+DEFAULT_PRESET = "map-ont"
+# Every minimap2 index starts with these bytes
+_MMI_MAGIC = b"MMI\2"
+_BLOCK = 1 << 20
+
+_help = "Build and cache minimap2 indexes"
+_cli = (
+    (
+        "references",
+        dict(
+            nargs="*",
+            help="FASTA references to index, or TOML files to index the reference of",
+        ),
+    ),
+    (
+        "--cache-dir",
+        dict(
+            default=None,
+            help="Directory to keep indexes in (default: $READFISH_INDEX_CACHE or ~/.cache/readfish/indexes)",
+        ),
+    ),
+    (
+        "--preset",
+        dict(
+            default=DEFAULT_PRESET,
+            help="minimap2 preset to build the index with (default: {})".format(DEFAULT_PRESET),
+        ),
+    ),
+    (
+        "--list",
+        dict(
+            action="store_true",
+            help="List the cached indexes",
+        ),
+    ),
+)
+
+
+def cache_dir(path=None):
+    """Return the index cache directory
+
+    Parameters
+    ----------
+    path : str, optional
+        Directory to use, if not given READFISH_INDEX_CACHE from the
+        environment, falling back to readfish/indexes in the user's cache
+        directory
+
+    Returns
+    -------
+    Path
+    """
+    if path is None:
+        path = os.environ.get("READFISH_INDEX_CACHE")
+    if path is None:
+        base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+        path = Path(base) / "readfish" / "indexes"
+    return Path(path).expanduser()
+
+
+def is_index(path):
+    """Return True if `path` is a minimap2 index rather than a sequence file"""
+    with open(str(path), "rb") as fh:
+        return fh.read(len(_MMI_MAGIC)) == _MMI_MAGIC
+
+
+def index_key(reference, preset=DEFAULT_PRESET, **params):
+    """Return the cache key of the index built from `reference`
+
+    The key is a hash of the reference's content, the preset, any other
+    index parameters and the version of mappy, so a changed FASTA or
+    different settings give a new index.
+
+    Parameters
+    ----------
+    reference : str
+        Path to a FASTA/Q file, optionally gzipped
+    preset : str
+        minimap2 preset
+    params
+        Other keyword arguments given to mappy.Aligner, e.g. k and w
+
+    Returns
+    -------
+    str
+        Hex digest
+    """
+    h = hashlib.sha1()
+    with open(str(reference), "rb") as fh:
+        for block in iter(lambda: fh.read(_BLOCK), b""):
+            h.update(block)
+    settings = dict(params, preset=preset, mappy=getattr(mp, "__version__", ""))
+    h.update(json.dumps(settings, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def cached_index(reference, preset=DEFAULT_PRESET, cache=None, build=True, **params):
+    """Return the path of a minimap2 index for `reference`, building it if needed
+
+    Parameters
+    ----------
+    reference : str
+        Path to a minimap2 index or FASTA/Q file. Indexes are returned as is.
+    preset : str
+        minimap2 preset
+    cache : str, optional
+        Cache directory, see `cache_dir`
+    build : bool
+        If False, return None rather than building a missing index
+    params
+        Other keyword arguments given to mappy.Aligner
+
+    Returns
+    -------
+    str or None
+        Path to the index, None if it is not cached and `build` is False
+
+    Raises
+    ------
+    RuntimeError
+        If minimap2 fails to build the index
+    """
+    if is_index(reference):
+        return str(reference)
+    directory = cache_dir(cache)
+    key = index_key(reference, preset, **params)
+    path = directory / "{}.mmi".format(key)
+    if path.is_file():
+        logger.info("Using cached index {} for {}".format(path, reference))
+        return str(path)
+    if not build:
+        return None
+
+    directory.mkdir(parents=True, exist_ok=True)
+    logger.info("Building index for {} in {}".format(reference, path))
+    # Build under a temporary name, so a partial index is never used
+    fd, tmp = tempfile.mkstemp(suffix=".mmi.tmp", dir=str(directory))
+    os.close(fd)
+    try:
+        aligner = mp.Aligner(str(reference), preset=preset, fn_idx_out=tmp, **params)
+        if not aligner:
+            raise RuntimeError("Failed to build index for {}".format(reference))
+        del aligner
+        os.replace(tmp, str(path))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    meta = dict(params, reference=str(Path(reference).resolve()), preset=preset)
+    with open(str(path.with_suffix(".json")), "w") as fh:
+        json.dump(meta, fh, indent=4)
+    return str(path)
+
+
+def reference_path(path):
+    """Return the reference of a TOML file, or `path` itself"""
+    if Path(path).suffix == ".toml":
+        return toml.load(path)["conditions"].get("reference", "")
+    return path
+
+
+def run(parser, args):
+    if args.list:
+        for meta in sorted(cache_dir(args.cache_dir).glob("*.json")):
+            with open(str(meta)) as fh:
+                info = json.load(fh)
+            print("{}\t{}\t{}".format(meta.with_suffix(".mmi"), info["preset"], info["reference"]))
+        return
+    if not args.references:
+        parser.error("the following arguments are required: references")
+
+    for ref in args.references:
+        reference = reference_path(ref)
+        if not Path(reference).is_file():
+            sys.exit("reference file not found at: {}".format(reference))
+        print(
+            "{}\t{}".format(
+                reference, cached_index(reference, preset=args.preset, cache=args.cache_dir)
+            )
+        )
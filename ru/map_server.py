@@ -0,0 +1,367 @@
+"""map_server.py
+
+Serve a single minimap2 index to several readfish processes on one host over
+a Unix socket, so the index is only held in memory once
+
+"""
+import logging
+import os
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+from timeit import default_timer as timer
+
+from ru.index import reference_path
+
+
+__all__ = ["Alignment", "MapClient", "MapServer", "alignment_tuple", "key_path"]
+
+logger = logging.getLogger("RU_map_server")
+
+_help = "Serve a minimap2 index to readfish processes on this host"
+_cli = (
+    (
+        "reference",
+        dict(help="minimap2 index or FASTA to serve, or a TOML file to serve the reference of"),
+    ),
+    (
+        "--socket",
+        dict(
+            default="readfish_map.sock",
+            help="Path of the Unix socket to listen on (default: readfish_map.sock)",
+        ),
+    ),
+    (
+        "--map-threads",
+        dict(
+            metavar="MAP-THREADS",
+            type=int,
+            default=4,
+            help="Number of threads used to map each batch of reads (default: 4)",
+        ),
+    ),
+    (
+        "--max-batch",
+        dict(
+            type=int,
+            default=1024,
+            help="Maximum number of reads, from all clients, mapped together (default: 1024)",
+        ),
+    ),
+    (
+        "--max-wait",
+        dict(
+            type=float,
+            default=0.002,
+            help="Time, in seconds, to wait for requests from other clients "
+                 "before mapping a batch (default: 0.002)",
+        ),
+    ),
+    (
+        "--log-file",
+        dict(
+            default=None,
+            help="Filename to log to, if not given logs go to the terminal",
+        ),
+    ),
+)
+
+# Picklable copy of mappy.Alignment, with the attributes readfish uses
+Alignment = namedtuple(
+    "Alignment",
+    [
+        "ctg",
+        "ctg_len",
+        "r_st",
+        "r_en",
+        "strand",
+        "q_st",
+        "q_en",
+        "mlen",
+        "blen",
+        "mapq",
+        "is_primary",
+        "trans_strand",
+        "cigar_str",
+    ],
+)
+
+
+def _alignment_str(self):
+    # Matches str(mappy.Alignment), the PAF columns from q_st onwards
+    return "\t".join(
+        (
+            str(self.q_st),
+            str(self.q_en),
+            "+" if self.strand > 0 else "-",
+            self.ctg,
+            str(self.ctg_len),
+            str(self.r_st),
+            str(self.r_en),
+            str(self.mlen),
+            str(self.blen),
+            str(self.mapq),
+            "tp:A:" + ("P" if self.is_primary else "S"),
+            "ts:A:" + ("+" if self.trans_strand > 0 else "-" if self.trans_strand < 0 else "."),
+            "cg:Z:" + self.cigar_str,
+        )
+    )
+
+
+Alignment.__str__ = _alignment_str
+
+
+def key_path(address):
+    """Return the path of the key file for the socket at `address`
+
+    >>> key_path("readfish_map.sock")
+    'readfish_map.sock.key'
+    """
+    return "{}.key".format(address)
+
+
+def alignment_tuple(r):
+    """Return an Alignment with the values of a mappy.Alignment"""
+    return Alignment(
+        r.ctg,
+        r.ctg_len,
+        r.r_st,
+        r.r_en,
+        r.strand,
+        r.q_st,
+        r.q_en,
+        r.mlen,
+        r.blen,
+        r.mapq,
+        r.is_primary,
+        r.trans_strand,
+        r.cigar_str,
+    )
+
+
+class MapClient:
+    """Map reads on a MapServer, with the interface of mappy.Aligner
+
+    Requests on one client are sent one at a time, a lock is held for each
+    round trip so the client can be shared between threads. A forked process
+    opens its own connection on its first request, rather than sharing the
+    parent's socket. The client authenticates with the key the server wrote
+    next to the socket, see `key_path`.
+
+    Parameters
+    ----------
+    address : str
+        Path of the server's Unix socket
+
+    Attributes
+    ----------
+    reference : str
+        The reference the server was started with
+    seq_names : list
+        Names of the sequences in the server's index
+    """
+
+    def __init__(self, address):
+        self.address = str(address)
+        self.conn = None
+        with open(key_path(self.address), "rb") as fh:
+            self.authkey = fh.read()
+        self._connect()
+        self.reference, self.seq_names = self._request("info", None)
+
+    def __bool__(self):
+        return self.conn is not None
+
+    def _connect(self):
+        self.pid = os.getpid()
+        # A lock copied by fork may have been held by another thread
+        self.lock = threading.Lock()
+        self.conn = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+
+    def _request(self, kind, payload):
+        if self.conn is not None and self.pid != os.getpid():
+            # Forked since connecting, the inherited socket is the parent's
+            self._connect()
+        with self.lock:
+            self.conn.send((kind, payload))
+            ok, reply = self.conn.recv()
+        if not ok:
+            raise RuntimeError("Map server {}: {}".format(self.address, reply))
+        return reply
+
+    def map(self, seq):
+        return iter(self.map_batch([seq])[0])
+
+    def map_batch(self, seqs):
+        """Map a batch of sequences, returning a list of Alignments for each"""
+        if not seqs:
+            return []
+        return self._request("map", list(seqs))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class MapServer:
+    """Map batches of reads sent by MapClients over a Unix socket
+
+    Each client connection is read on its own thread. Requests from every
+    client are queued and mapped together, up to `max_batch` reads at a time,
+    so that the mapping threads are kept busy when several clients each send
+    small batches.
+
+    The socket and a random key, written to `key_path(address)`, are created
+    readable only by the user running the server. Clients must prove they
+    hold the key before anything they send is unpickled.
+
+    Parameters
+    ----------
+    mapper : ru.basecall.Mapper
+        Loaded mapper, its `map_batch` is used to map each batch
+    address : str
+        Path of the Unix socket to listen on
+    max_batch : int
+        Maximum number of reads mapped together
+    max_wait : float
+        Time, in seconds, to wait for more requests once one has arrived
+    """
+
+    def __init__(self, mapper, address, max_batch=1024, max_wait=0.002):
+        self.mapper = mapper
+        self.address = str(address)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.listener = None
+        self.running = False
+        self.clients = 0
+        self.batches = 0
+        self.mapped = 0
+
+    def serve_forever(self):
+        """Accept clients until `shutdown` is called"""
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        authkey = os.urandom(32)
+        # Create the key file and socket private, rather than restricting
+        # them after another user may already have opened them
+        umask = os.umask(0o077)
+        try:
+            fd = os.open(key_path(self.address), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(authkey)
+            self.listener = Listener(self.address, family="AF_UNIX", authkey=authkey)
+        finally:
+            os.umask(umask)
+        self.running = True
+        batcher = threading.Thread(target=self._map_requests, name="batcher", daemon=True)
+        batcher.start()
+        logger.info("Serving {} on {}".format(self.mapper.index, self.address))
+        try:
+            while self.running:
+                try:
+                    conn = self.listener.accept()
+                except AuthenticationError as e:
+                    logger.warning("Rejected client: {}".format(e))
+                    continue
+                except OSError:
+                    # The listener was closed
+                    break
+                threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self.running = False
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        for path in (self.address, key_path(self.address)):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _serve_client(self, conn):
+        self.clients += 1
+        logger.info("Client connected, {} connected".format(self.clients))
+        try:
+            while self.running:
+                try:
+                    kind, payload = conn.recv()
+                except EOFError:
+                    break
+                if kind == "info":
+                    conn.send((True, (self.mapper.index, list(self.mapper.mapper.seq_names))))
+                elif kind == "map":
+                    result = Future()
+                    self.requests.put((payload, result))
+                    try:
+                        conn.send((True, result.result()))
+                    except Exception as e:
+                        conn.send((False, str(e)))
+                else:
+                    conn.send((False, "unknown request {!r}".format(kind)))
+        except OSError as e:
+            logger.warning("Client connection failed: {}".format(e))
+        finally:
+            conn.close()
+            self.clients -= 1
+            logger.info("Client disconnected, {} connected".format(self.clients))
+
+    def _map_requests(self):
+        while self.running:
+            batch = [self.requests.get()]
+            n = len(batch[0][0])
+            deadline = timer() + self.max_wait
+            while n < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - timer(), 0)))
+                except queue.Empty:
+                    break
+                n += len(batch[-1][0])
+
+            seqs = [seq for request, _ in batch for seq in request]
+            try:
+                mapped = self.mapper.map_batch(seqs)
+            except Exception as e:
+                logger.error("Failed to map batch: {}".format(e))
+                for _, result in batch:
+                    result.set_exception(e)
+                continue
+            mapped = iter(mapped)
+            for request, result in batch:
+                result.set_result(
+                    [[alignment_tuple(r) for r in next(mapped)] for _ in request]
+                )
+            self.batches += 1
+            self.mapped += len(seqs)
+
+
+def run(parser, args):
+    from ru.basecall import Mapper
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(name)s %(message)s",
+        filename=args.log_file,
+    )
+    reference = reference_path(args.reference)
+    if not Path(reference).is_file():
+        parser.error("reference file not found at: {}".format(reference))
+
+    mapper = Mapper(reference, threads=args.map_threads)
+    if not mapper.mapper:
+        parser.error("failed to load index for {}".format(reference))
+    server = MapServer(mapper, args.socket, max_batch=args.max_batch, max_wait=args.max_wait)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Mapped {} reads in {} batches".format(server.mapped, server.batches))
+        mapper.close()
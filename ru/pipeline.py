@@ -0,0 +1,199 @@
+"""pipeline.py
+
+Run the fetch, basecall and map steps of the analysis loop as separate threads
+connected by bounded queues
+
+"""
+import logging
+import queue
+import threading
+import time
+from timeit import default_timer as timer
+
+
+__all__ = ["Pipeline", "Stage"]
+
+logger = logging.getLogger("RU_pipeline")
+
+
+class Stage(threading.Thread):
+    """A pipeline stage that runs on its own thread
+
+    A stage with an `inbox` calls `fn(item)` for every item taken from it. A
+    stage without an `inbox` is a source and calls `fn()` repeatedly, calling
+    `wait(throttle)`, or sleeping `throttle` seconds, whenever it returns
+    nothing. Non-empty results are put on `outbox`, blocking while it is full.
+    An exception raised by `fn` is logged and kept in `error`, and the stage
+    exits.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage, used for logging
+    fn : callable
+        The work done by this stage
+    inbox : queue.Queue or None
+        Queue to take work from, None for a source stage
+    outbox : queue.Queue
+        Queue to put results on
+    running : callable
+        Returns False when the stage should exit
+    throttle : int or float
+        Time, in seconds, to wait when there is no work
+    wait : callable, optional
+        Called with `throttle` by a source stage that found no work, should
+        return early when new work is available
+    """
+
+    def __init__(self, name, fn, inbox, outbox, running, throttle=0.1, wait=None):
+        super().__init__(name=name, daemon=True)
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.running = running
+        self.throttle = throttle
+        self.wait = time.sleep if wait is None else wait
+        self.busy = 0.0
+        self.items = 0
+        self.error = None
+        self.started_at = timer()
+
+    def run(self):
+        self.started_at = timer()
+        try:
+            self._run()
+        except Exception as e:
+            logger.exception("Stage {} failed".format(self.name))
+            self.error = e
+
+    def _run(self):
+        while self.running():
+            if self.inbox is None:
+                t0 = timer()
+                out = self.fn()
+            else:
+                try:
+                    item = self.inbox.get(timeout=self.throttle)
+                except queue.Empty:
+                    continue
+                t0 = timer()
+                out = self.fn(item)
+            self.busy += timer() - t0
+
+            if not out:
+                if self.inbox is None:
+                    self.wait(self.throttle)
+                continue
+
+            self.items += 1
+            while self.running():
+                try:
+                    self.outbox.put(out, timeout=self.throttle)
+                    break
+                except queue.Full:
+                    continue
+
+    def occupancy(self):
+        """Fraction of time since the stage started spent doing work"""
+        elapsed = timer() - self.started_at
+        return self.busy / elapsed if elapsed > 0 else 0.0
+
+
+class Pipeline:
+    """A chain of stages, each on its own thread, joined by bounded queues
+
+    The consumer, normally the decision loop, takes results from the last queue
+    with `get` and reports the time it spends on each with `task_done` so that
+    its occupancy is included in `stats`. If any stage fails the others stop
+    and `get` raises.
+
+    Parameters
+    ----------
+    stages : Sequence[Tuple[str, callable]]
+        (name, fn) for each stage in order. The first stage is a source and is
+        called with no arguments, the rest are called with the previous
+        stage's result
+    running : callable
+        Returns False when the pipeline should stop
+    depth : int
+        Maximum number of items held between two stages
+    throttle : int or float
+        Time, in seconds, that stages wait when there is no work
+    consumer : str
+        Name given to the consumer in `stats`
+    wait : callable, optional
+        Passed to the source stage, see `Stage`
+    """
+
+    def __init__(self, stages, running, depth=2, throttle=0.1, consumer="decide", wait=None):
+        self.queues = [queue.Queue(maxsize=depth) for _ in stages]
+        self.stages = []
+        inbox = None
+        for (name, fn), outbox in zip(stages, self.queues):
+            self.stages.append(
+                Stage(
+                    name,
+                    fn,
+                    inbox,
+                    outbox,
+                    lambda: running() and self.failed is None,
+                    throttle=throttle,
+                    wait=wait,
+                )
+            )
+            inbox = outbox
+        self.consumer = consumer
+        self.consumer_busy = 0.0
+        self.started_at = timer()
+
+    def start(self):
+        self.started_at = timer()
+        for stage in self.stages:
+            stage.start()
+
+    def join(self, timeout=None):
+        for stage in self.stages:
+            stage.join(timeout)
+
+    @property
+    def failed(self):
+        """The first stage that failed, or None"""
+        return next((stage for stage in self.stages if stage.error is not None), None)
+
+    def get(self, timeout=None):
+        """Return the next result from the last stage, None on timeout
+
+        Raises
+        ------
+        RuntimeError
+            If a stage has failed
+        """
+        failed = self.failed
+        if failed is not None:
+            raise RuntimeError("Pipeline stage {} failed".format(failed.name)) from failed.error
+        try:
+            return self.queues[-1].get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def task_done(self, elapsed):
+        """Record `elapsed` seconds of consumer work"""
+        self.consumer_busy += elapsed
+
+    def depths(self):
+        """Return the number of items waiting after each stage"""
+        return [q.qsize() for q in self.queues]
+
+    def stats(self):
+        """Return a summary string of stage occupancy and queue depths"""
+        s = [
+            "{} {:.0%} [q {}/{}]".format(stage.name, stage.occupancy(), q.qsize(), q.maxsize)
+            for stage, q in zip(self.stages, self.queues)
+        ]
+        elapsed = timer() - self.started_at
+        s.append(
+            "{} {:.0%}".format(
+                self.consumer, self.consumer_busy / elapsed if elapsed > 0 else 0.0
+            )
+        )
+        return ", ".join(s)
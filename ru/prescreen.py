@@ -0,0 +1,193 @@
+"""prescreen.py
+
+Signal-level screening of chunks before they are basecalled
+
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from ru.utils import Decision
+
+
+__all__ = ["PreScreen", "SignalStats", "signal_stats", "RULES"]
+
+# Rules in the order they are checked, each is a table in the [prescreen] TOML
+#  table and gives chunks that match it the outcome "prescreen_<rule>"
+RULES = ("short", "flat", "saturated", "stall")
+STATS = ("length", "median", "mad", "range")
+
+SignalStats = namedtuple("SignalStats", STATS)
+
+
+def signal_stats(signals, stats=STATS):
+    """Length, median, median absolute deviation and range of each signal
+
+    Chunks of the same length, usually most of a batch, are stacked so each
+    statistic is a single reduction along axis 1.
+
+    Parameters
+    ----------
+    signals : Sequence[np.ndarray]
+        One array of signal for each chunk
+    stats : Iterable[str]
+        Statistics to compute, from STATS. The length is always given, the
+        others are None unless requested
+
+    Returns
+    -------
+    SignalStats
+        Arrays with one element per chunk, empty chunks have zero statistics
+
+    Examples
+    --------
+    >>> s = signal_stats([np.array([1., 2., 3., 10.]), np.array([5., 5.]), np.array([])])
+    >>> s.length.tolist(), s.median.tolist(), s.mad.tolist(), s.range.tolist()
+    ([4, 2, 0], [2.5, 5.0, 0.0], [1.0, 0.0, 0.0], [9.0, 0.0, 0.0])
+    >>> s = signal_stats([np.array([1, 9], dtype=np.int16)], stats=("range",))
+    >>> s.length.tolist(), s.median, s.range.tolist()
+    ([2], None, [8.0])
+    """
+    n = len(signals)
+    lengths = np.fromiter((len(s) for s in signals), dtype=np.int64, count=n)
+    values = {stat: np.zeros(n) if stat in stats else None for stat in STATS[1:]}
+    if not n or not any(v is not None for v in values.values()):
+        return SignalStats(lengths, **values)
+
+    order = np.argsort(lengths, kind="stable")
+    for group in np.split(order, np.flatnonzero(np.diff(lengths[order])) + 1):
+        if not lengths[group[0]]:
+            continue
+        block = np.stack([signals[i] for i in group])
+        if values["median"] is not None or values["mad"] is not None:
+            median = np.median(block, axis=1)
+            if values["median"] is not None:
+                values["median"][group] = median
+            if values["mad"] is not None:
+                # float32 holds deviations of integer signal exactly, at half
+                #  the memory traffic of float64
+                dev = np.abs(block - median[:, None].astype(np.float32))
+                values["mad"][group] = np.median(dev, axis=1)
+        if values["range"] is not None:
+            values["range"][group] = block.max(axis=1).astype(float) - block.min(axis=1)
+    return SignalStats(lengths, **values)
+
+
+class PreScreen:
+    """Route chunks by their signal statistics without basecalling them
+
+    Each rule is a set of bounds on the statistics from `signal_stats`, given
+    as `min_<stat>` and `max_<stat>`, and an `action`. A chunk matches a rule
+    if it is within every bound, and takes the first rule in RULES that it
+    matches. Matched chunks are not basecalled; their signal is still kept so
+    that later chunks of the read are called in full.
+
+    Parameters
+    ----------
+    rules : dict
+        {rule: {bound: value, ..., "action": mode}} the [prescreen] TOML table,
+        where rule is one of RULES and mode is "unblock", "stop_receiving" or
+        "proceed"
+
+    Examples
+    --------
+    >>> screen = PreScreen({"short": {"max_length": 2, "action": "proceed"},
+    ...                     "flat": {"max_mad": 0.5, "action": "unblock"}})
+    >>> screen.match(signal_stats([np.ones(2), np.ones(8), np.arange(8.)])).tolist()
+    ['prescreen_short', 'prescreen_flat', None]
+    >>> screen.actions["prescreen_flat"] == Decision.UNBLOCK
+    True
+    """
+
+    def __init__(self, rules):
+        self.rules = []
+        self.actions = {}
+        # Statistics referenced by the rules, only these are computed
+        self.needed = set()
+        for name in RULES:
+            if name not in rules:
+                continue
+            rule = dict(rules[name])
+            outcome = "prescreen_{}".format(name)
+            self.actions[outcome] = Decision[rule.pop("action").upper()]
+            bounds = []
+            for key, value in rule.items():
+                side, stat = key.split("_", 1)
+                bounds.append((STATS.index(stat), side == "min", value))
+                self.needed.add(stat)
+            self.rules.append((outcome, bounds))
+        # Running totals, reported by `stats`
+        self.screened = 0
+        self.counts = {outcome: 0 for outcome in self.actions}
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def match(self, stats):
+        """Return the outcome of the first rule each chunk matches, else None"""
+        outcome = np.full(len(stats.length), None, dtype=object)
+        unmatched = np.ones(len(stats.length), dtype=bool)
+        for name, bounds in self.rules:
+            hit = unmatched.copy()
+            for stat, is_min, value in bounds:
+                hit &= stats[stat] >= value if is_min else stats[stat] <= value
+            outcome[hit] = name
+            unmatched &= ~hit
+        return outcome
+
+    def split(self, reads, signal_dtype, store):
+        """Separate chunks that match a rule from those to basecall
+
+        Parameters
+        ----------
+        reads : iterable[Tuple[int, rpc.Read]]
+            (channel, read) chunks
+        signal_dtype
+            Numpy dtype of the raw data
+        store : ru.basecall.SignalStore
+            Signal seen so far for the current read on each channel, matched
+            chunks are added to it
+
+        Returns
+        -------
+        fresh : list
+            (channel, read) of each chunk to basecall
+        screened : list
+            (channel, read_number, read_id, outcome) of each matched chunk
+        """
+        reads = list(reads)
+        if not self.rules or not reads:
+            return reads, []
+        dtype = np.dtype(signal_dtype)
+        if self.needed <= {"length"}:
+            # No need to decode the signal
+            lengths = [len(read.raw_data) // dtype.itemsize for _, read in reads]
+            stats = SignalStats(np.array(lengths, dtype=np.int64), None, None, None)
+        else:
+            stats = signal_stats(
+                [np.frombuffer(read.raw_data, dtype) for _, read in reads], self.needed
+            )
+        outcomes = self.match(stats)
+        if store.dtype is None:
+            store.dtype = dtype
+        fresh, screened = [], []
+        for chunk, outcome in zip(reads, outcomes):
+            if outcome is None:
+                fresh.append(chunk)
+                continue
+            channel, read = chunk
+            store.append(channel, read.id, read.raw_data)
+            screened.append((channel, read.number, read.id, outcome))
+            self.counts[outcome] += 1
+        self.screened += len(reads)
+        return fresh, screened
+
+    def stats(self):
+        """Return a summary string of the chunks kept from the basecaller"""
+        kept = sum(self.counts.values())
+        return "{} of {} chunks not basecalled ({:.1%}){}".format(
+            kept,
+            self.screened,
+            kept / self.screened if self.screened else 0.0,
+            "".join(", {} {}".format(k, v) for k, v in self.counts.items()),
+        )
@@ -0,0 +1,151 @@
+"""read_cache.py
+
+Wrapper for the ReadUntilClient read cache that wakes the analysis loop when
+chunks arrive, records how long chunks wait before they are pulled and stamps
+each chunk with the time it arrived
+
+"""
+import threading
+import time
+from timeit import default_timer as timer
+
+
+__all__ = ["ReceivedChunk", "WatchedCache", "chunk_age", "wait_for_chunks"]
+
+
+class ReceivedChunk(tuple):
+    """A (channel, read) chunk with `received`, the time it was cached
+
+    Unpacks as the plain (channel, read) tuple returned by the client.
+
+    Examples
+    --------
+    >>> chunk = ReceivedChunk((1, "read"), received=10.0)
+    >>> channel, read = chunk
+    >>> channel, read, chunk.received
+    (1, 'read', 10.0)
+    """
+
+    def __new__(cls, chunk, received=None):
+        self = super().__new__(cls, chunk)
+        self.received = received
+        return self
+
+
+def chunk_age(chunk, now=None):
+    """Seconds since a chunk was cached, None if it has no receive time"""
+    received = getattr(chunk, "received", None)
+    if received is None:
+        return None
+    return (timer() if now is None else now) - received
+
+
+class WatchedCache:
+    """Wrap a read_until read cache to signal arrivals
+
+    Replaces `client.data_queue` before the client is started. Every write by
+    the client records the arrival time for the channel and, once `fill`
+    channels have chunks waiting, wakes any thread blocked in `wait`. When
+    chunks are pulled with `popitems` the time they spent in the cache is
+    recorded and they are returned as ReceivedChunk.
+
+    All other attributes are taken from the wrapped cache.
+
+    Parameters
+    ----------
+    cache : read_until_api_v2.read_cache.ReadCache
+        The cache created by the ReadUntilClient
+    fill : int
+        The number of channels with waiting chunks that wakes waiters, 0 to
+        only record arrival times
+    """
+
+    def __init__(self, cache, fill=1):
+        self.cache = cache
+        self.fill = fill
+        self.cond = threading.Condition()
+        self.received = {}
+        self.pulled = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def __setitem__(self, key, value):
+        self.cache[key] = value
+        with self.cond:
+            self.received[key] = timer()
+            if self.fill and len(self.cache) >= self.fill:
+                self.cond.notify_all()
+
+    def __getitem__(self, key):
+        return self.cache[key]
+
+    def __delitem__(self, key):
+        del self.cache[key]
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def __iter__(self):
+        return iter(self.cache)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def popitems(self, items=1, last=True):
+        """Pop chunks from the wrapped cache, recording how long they waited"""
+        chunks = self.cache.popitems(items, last)
+        now = timer()
+        stamped = []
+        with self.cond:
+            for chunk in chunks:
+                received = self.received.pop(chunk[0], now)
+                self.wait_total += now - received
+                self.wait_max = max(self.wait_max, now - received)
+                stamped.append(ReceivedChunk(chunk, received))
+            self.pulled += len(chunks)
+        return stamped
+
+    def wait(self, timeout):
+        """Block until `fill` channels have chunks or `timeout` seconds pass
+
+        Returns
+        -------
+        bool
+            True if woken because chunks are waiting
+        """
+        if not self.fill:
+            time.sleep(timeout)
+            return False
+        with self.cond:
+            return self.cond.wait_for(lambda: len(self.cache) >= self.fill, timeout)
+
+    def stats(self):
+        """Return a summary string of the time chunks spent in the cache"""
+        return "{} chunks pulled, mean wait {:.5f}s, max wait {:.5f}s".format(
+            self.pulled,
+            self.wait_total / self.pulled if self.pulled else 0.0,
+            self.wait_max,
+        )
+
+
+def wait_for_chunks(client, timeout):
+    """Wait up to `timeout` seconds for new chunks on a client
+
+    Uses `client.wait_for_chunks` if the client provides it, then a
+    `WatchedCache` on `client.data_queue`, and otherwise sleeps for `timeout`.
+
+    Returns
+    -------
+    bool
+        True if woken because chunks are waiting
+    """
+    waiter = getattr(client, "wait_for_chunks", None)
+    if waiter is None:
+        waiter = getattr(getattr(client, "data_queue", None), "wait", None)
+    if waiter is None:
+        time.sleep(timeout)
+        return False
+    return waiter(timeout)
@@ -8,13 +8,14 @@ edited to 0.2-0.4:
 (<MinKNOW_folder>/ont-python/lib/python2.7/site-packages/bream4/configuration)
 """
 # Core imports
+import asyncio
 import concurrent.futures
 import functools
 import logging
 import sys
+import threading
 import time
 import traceback
-from collections import defaultdict, deque, Counter
 from multiprocessing import TimeoutError
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
@@ -26,19 +27,43 @@ import toml
 
 from ru.arguments import get_parser, BASE_ARGS
 from ru.basecall import Mapper as CustomMapper
-from ru.basecall import GuppyCaller as Caller
-from ru.utils import print_args, get_run_info, between, setup_logger, describe_experiment
-from ru.utils import send_message, Severity
+from ru.basecall import get_caller
+from ru.basecall import SignalStore
+from ru.utils import print_args, get_run_info, setup_logger, describe_experiment, load_config_toml
+from ru.utils import LiveTOMLWatcher
+from ru.utils import send_message, Severity, Decision, MODE_INDEX
+from ru.classify import classify_batch, read_info_arrays, OUTCOMES
+from ru.state import ChannelState
+from ru.actions import ActionBuffer
+from ru.aio import AsyncGuppyCaller, run_event_loop
+from ru.dispatch import ChannelDispatcher, ProcessDispatcher
+from ru.pipeline import Pipeline
+from ru.prescreen import PreScreen
+from ru.read_cache import WatchedCache, wait_for_chunks
 
 
 _help = "Run targeted sequencing"
-_cli = BASE_ARGS + (
+_cli = tuple(arg for arg in BASE_ARGS if arg[0] != "--device") + (
+    (
+        "--device",
+        dict(
+            metavar="DEVICE",
+            type=str,
+            nargs="+",
+            help="Name of the sequencing position e.g. MS29042 or X1 etc. "
+                 "Several positions can be run by one process, sharing the "
+                 "reference index",
+            required=True,
+        ),
+    ),
     (
         "--toml",
         dict(
             metavar="TOML",
+            nargs="+",
             required=True,
-            help="TOML file specifying experimental parameters",
+            help="TOML file specifying experimental parameters, either one "
+                 "for all devices or one for each device in the same order",
         ),
     ),
     (
@@ -55,6 +80,155 @@ _cli = BASE_ARGS + (
             default="chunk_log.log",
         )
     ),
+    (
+        "--processes",
+        dict(
+            metavar="PROCESSES",
+            type=int,
+            help="Run analysis in this many forked worker processes, each owning "
+                 "a shard of the channels, instead of worker threads (default: 0)",
+            default=0,
+        )
+    ),
+    (
+        "--wake-fill",
+        dict(
+            metavar="WAKE-FILL",
+            type=int,
+            help="Wake the analysis loop as soon as this many channels have chunks "
+                 "waiting, rather than always waiting out --throttle; 0 disables "
+                 "(default: 0)",
+            default=0,
+        )
+    ),
+    (
+        "--map-threads",
+        dict(
+            metavar="MAP-THREADS",
+            type=int,
+            help="Number of threads used to map each batch of reads (default: 1)",
+            default=1,
+        )
+    ),
+    (
+        "--map-server",
+        dict(
+            metavar="SOCKET",
+            default=None,
+            help="Map reads on the 'readfish map-server' listening on this socket "
+                 "instead of loading the reference in this process (default: None)",
+        )
+    ),
+    (
+        "--pipeline",
+        dict(
+            action="store_true",
+            help="Run fetching, basecalling and mapping as separate pipelined stages",
+        )
+    ),
+    (
+        "--pipeline-depth",
+        dict(
+            metavar="PIPELINE-DEPTH",
+            type=int,
+            help="Maximum number of batches queued between pipeline stages (default: 2)",
+            default=2,
+        )
+    ),
+    (
+        "--window-overlap",
+        dict(
+            metavar="SAMPLES",
+            type=int,
+            help="Basecall only the newest chunk of a read plus this many samples "
+                 "of overlap, stitching the new bases onto the read's sequence "
+                 "(default: basecall the whole read)",
+            default=None,
+        )
+    ),
+    (
+        "--basecall-timeout",
+        dict(
+            metavar="SECONDS",
+            type=float,
+            help="Time to wait for each batch to be basecalled, reads not called "
+                 "in time are logged as basecall_timeout and left to sequence "
+                 "(default: 2.0)",
+            default=2.0,
+        )
+    ),
+    (
+        "--max-in-flight",
+        dict(
+            metavar="READS",
+            type=int,
+            help="Collect basecalls while a batch is still being submitted, with "
+                 "at most this many reads awaiting results, so that reads are "
+                 "mapped as soon as they are called (default: submit the whole "
+                 "batch first)",
+            default=None,
+        )
+    ),
+    (
+        "--max-chunk-age",
+        dict(
+            metavar="SECONDS",
+            type=float,
+            help="Skip basecalling chunks that waited longer than this in the read "
+                 "cache, they are logged with mode stale (default: no limit)",
+            default=None,
+        )
+    ),
+    (
+        "--signal-budget",
+        dict(
+            metavar="MIB",
+            type=float,
+            help="Memory, in MiB, that may be used to hold read signal, split "
+                 "evenly between every worker of every device; the least "
+                 "recently updated channels are dropped when a worker's share "
+                 "is exceeded (default: no limit)",
+            default=None,
+        )
+    ),
+    (
+        "--max-read-samples",
+        dict(
+            metavar="SAMPLES",
+            type=int,
+            help="Keep only this many of the newest samples of each read for "
+                 "basecalling (default: no limit)",
+            default=None,
+        )
+    ),
+    (
+        "--asyncio",
+        dict(
+            action="store_true",
+            help="Basecall and decide on an asyncio event loop, keeping reads in "
+                 "flight across batches instead of calling one batch at a time",
+        )
+    ),
+    (
+        "--action-batch-size",
+        dict(
+            metavar="ACTION-BATCH-SIZE",
+            type=int,
+            help="Send held unblock/stop_receiving actions once this many are "
+                 "buffered (default: 512)",
+            default=512,
+        )
+    ),
+    (
+        "--action-max-wait",
+        dict(
+            metavar="ACTION-MAX-WAIT",
+            type=float,
+            help="Maximum time, in seconds, to hold unblock/stop_receiving "
+                 "actions before they are sent (default: 0.1)",
+            default=0.1,
+        )
+    ),
 )
 
 class ThreadPoolExecutorStackTraced(concurrent.futures.ThreadPoolExecutor):
@@ -92,6 +266,21 @@ def simple_analysis(
         conditions=None,
         mapper=None,
         caller_kwargs=None,
+        plan=None,
+        action_batch_size=512,
+        action_max_wait=0.1,
+        pipeline=False,
+        pipeline_depth=2,
+        window_overlap=None,
+        basecall_timeout=None,
+        max_in_flight=None,
+        use_asyncio=False,
+        max_chunk_age=None,
+        prescreen=None,
+        signal_budget=None,
+        max_read_samples=None,
+        device=None,
+        caller=None,
 ):
     """Analysis function
 
@@ -122,13 +311,56 @@ def simple_analysis(
         Experimental conditions as List of namedtuples.
     mapper : mappy.Aligner
     caller_kwargs : dict
+        The `caller_settings` TOML table, see ru.basecall.get_caller
+    plan : ru.utils.ExperimentPlan
+        Per-channel arrays compiled from `run_info` and `conditions`
+    action_batch_size : int
+        Number of buffered actions that triggers sending them to the client
+    action_max_wait : int or float
+        Maximum time, in seconds, that actions are buffered for
+    pipeline : bool
+        If True fetch, basecall and map each run on their own thread, joined
+        by bounded queues, while this function makes the decisions
+    pipeline_depth : int
+        Maximum number of batches held between two pipeline stages
+    window_overlap : int, optional
+        If given, basecall only the newest chunk of a read plus this many
+        samples of overlap and stitch the bases onto the read's sequence
+    basecall_timeout : int or float, optional
+        Time, in seconds, to wait for each batch to be basecalled. If not
+        given wait until every read in the batch is called
+    max_in_flight : int, optional
+        If given, results are collected while the batch is submitted with at
+        most this many reads awaiting results, and reads are mapped as they
+        are called
+    use_asyncio : bool
+        If True reads are basecalled on an asyncio event loop, each read is
+        submitted as it arrives and decisions are made as reads are called.
+        `pipeline` is ignored
+    max_chunk_age : int or float, optional
+        Chunks that waited longer than this many seconds in the read cache are
+        not basecalled and are logged as stale. Requires the read cache to be
+        a ru.read_cache.WatchedCache
+    prescreen : dict, optional
+        The [prescreen] TOML table, chunks that match one of its rules are
+        not basecalled and take the rule's action, see ru.prescreen.PreScreen
+    signal_budget : int or float, optional
+        Memory, in MiB, for buffered read signal, see ru.basecall.SignalStore
+    max_read_samples : int, optional
+        Maximum number of samples of a read kept for basecalling
+    device : str, optional
+        Name of the sequencing position, added to the logger name when
+        several positions are run by one process
+    caller : ru.basecall.GuppyCaller or ru.basecall.GuppyCallerPool, optional
+        Basecaller connection shared with other analyses, if not given one is
+        opened from `caller_kwargs`
 
     Returns
     -------
     None
     """
     # Init logger for this function
-    logger = logging.getLogger(__name__)
+    logger = logging.getLogger(__name__ if device is None else "{}.{}".format(__name__, device))
 
     # Delete live TOML file if it exists
     live_toml_path = Path(live_toml_path)
@@ -148,40 +380,35 @@ def simple_analysis(
         fh.write("# In the future this file may become a CSV file.\n")
         toml.dump(d, fh)
 
-    caller = Caller(**caller_kwargs)
+    # Calls are routed back to this analysis when the connection is shared
+    caller = get_caller(caller_kwargs) if caller is None else caller.share()
     # What if there is no reference or an empty MMI
+    # The mapper may be shared with other workers and devices
+    mapper = mapper.share()
 
-    # DefaultDict[int: collections.deque[Tuple[str, ndarray]]]
-    #  tuple is (read_id, previous_signal)
-    # TODO: tuple should use read_number instead
-    previous_signal = defaultdict(functools.partial(deque, maxlen=1))
-    # count how often a read is seen
-    tracker = defaultdict(Counter)
-    # decided
-    decided_reads = {}
-    strand_converter = {1: "+", -1: "-"}
-
-    read_id = ""
-
-    # TODO: partial-ise / lambda unblock to take the unblock duration
+    # Signal seen so far for the current read on each channel
+    previous_signal = SignalStore(
+        max_bytes=None if signal_budget is None else int(signal_budget * 2 ** 20),
+        max_samples=max_read_samples,
+    )
+    # chunk counts and decisions for the current read on each channel
+    state = ChannelState(flowcell_size)
+    # Signal checks that keep obviously unusable chunks from the basecaller
+    prescreen = PreScreen(prescreen or {})
+
+    # Decisions are buffered and sent in groups, in a dry run unblocks
+    #  are replaced with stop_receiving
+    actions = ActionBuffer(
+        client,
+        unblock_duration=unblock_duration,
+        dry_run=dry_run,
+        max_size=action_batch_size,
+        max_wait=action_max_wait,
+    )
     if dry_run:
-        decision_dict = {
-            "stop_receiving": client.stop_receiving_read,
-            "proceed": None,
-            "unblock": client.stop_receiving_read,
-        }
         send_message(client.connection,"This is a test run. No unblocks will occur.",Severity.WARN)
     else:
-        decision_dict = {
-            "stop_receiving": client.stop_receiving_read,
-            "proceed": None,
-            "unblock": lambda c, n: client.unblock_read(c, n, unblock_duration, read_id),
-        }
         send_message(client.connection, "This is a live run. Unblocks will occur.", Severity.WARN)
-    decision_str = ""
-    below_threshold = False
-    exceeded_threshold = False
-
     l_string = (
         "client_iteration",
         "read_in_loop",
@@ -199,63 +426,177 @@ def simple_analysis(
         "end_analysis",
         "timestamp",
     )
+
+    def decision_name(mode, cond):
+        # The configured action for a mode, otherwise the mode itself
+        if mode in MODE_INDEX:
+            return Decision(plan.actions[MODE_INDEX[mode], cond]).name.lower()
+        if mode in prescreen.actions:
+            return prescreen.actions[mode].name.lower()
+        return mode
+
+    def fetch():
+        return client.get_read_chunks(batch_size=batch_size, last=True)
+
+    def basecall(reads, stream=False):
+        calls = caller.basecall_minknow(
+            reads=reads,
+            signal_dtype=client.signal_dtype,
+            prev_signal=previous_signal,
+            decided_reads=state,
+            window_overlap=window_overlap,
+            timeout=basecall_timeout,
+            max_in_flight=max_in_flight,
+            max_age=max_chunk_age,
+            prescreen=prescreen,
+        )
+        # Streamed calls are mapped as they arrive
+        return calls if stream else list(calls)
+
+    def align(calls):
+        # `mapper` may be replaced when the live TOML is reloaded, a batch keeps
+        #  the mapper it started with until it is finished
+        while True:
+            current = mapper
+            with current.use():
+                if current.retired:
+                    continue
+                if not current.initialised:
+                    return []
+                return list(current.map_reads_2(calls, min_seq_len=plan.min_seq_len))
+
+    stages = None
+    if pipeline and not use_asyncio:
+        stages = Pipeline(
+            [("fetch", fetch), ("basecall", basecall), ("map", align)],
+            running=lambda: client.is_running,
+            depth=pipeline_depth,
+            throttle=throttle,
+            wait=lambda timeout: wait_for_chunks(client, timeout),
+        )
+        stages.start()
+        last_stats = timer()
+
     cl.debug("\t".join(l_string))
     l_string = "\t".join(("{}" for _ in l_string))
-    loop_counter = 0
-    while client.is_running:
-        if live_toml_path.is_file():
-            # Reload the TOML config from the *_live file
-            run_info, conditions, new_reference, _ = get_run_info(live_toml_path, flowcell_size)
-
-            # Check the reference path if different from the loaded mapper
-            if new_reference != mapper.index:
-                old_reference = mapper.index
-                # Log to file and MinKNOW interface
-                logger.info("Reloading mapper")
-                send_message(client.connection, "Reloading mapper. ReadFish paused.", Severity.INFO)
-
-                # Update mapper client.
-                mapper = CustomMapper(new_reference)
-                # Log on success
-                logger.info("Reloaded mapper")
-
-                # If we've reloaded a reference, delete the previous one
-                if old_reference:
-                    logger.info("Deleting old mmi {}".format(old_reference))
-                    # We now delete the old mmi file.
-                    Path(old_reference).unlink()
-                    logger.info("Old mmi deleted.")
 
-        # TODO: Fix the logging to just one of the two in use
+    # A new reference is indexed on this thread while `mapper` keeps serving
+    index_loader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    # (reference, Future) for the mapper being built, if any
+    loading = None
+    # Replaced mappers, freed once no batch is using them
+    retired = []
 
-        if not mapper.initialised:
-            time.sleep(throttle)
-            continue
+    # Reads the *_live TOML only when its content changes
+    watcher = LiveTOMLWatcher(live_toml_path, flowcell_size)
 
-        loop_counter += 1
-        t0 = timer()
-        r = 0
+    def reload():
+        nonlocal run_info, conditions, plan, loading
+        try:
+            change = watcher.poll()
+        except Exception as e:
+            logger.warning("Failed to reload {}: {}".format(live_toml_path, e))
+            return
+        if change is None:
+            return
+        run_info, conditions, plan = change.run_info, change.conditions, change.plan
+        new_reference = change.reference
+        logger.info(
+            "Reloaded live TOML ({}) in {:.5f}s".format(
+                ", ".join(sorted(change.changed)), change.elapsed
+            )
+        )
 
-        for read_info, read_id, seq_len, results in mapper.map_reads_2(
-                caller.basecall_minknow(
-                    reads=client.get_read_chunks(batch_size=batch_size, last=True),
-                    signal_dtype=client.signal_dtype,
-                    prev_signal=previous_signal,
-                    decided_reads=decided_reads,
+        # Check the reference path if different from the loaded mapper
+        building = None if loading is None else loading[0]
+        if new_reference != mapper.index and new_reference != building:
+            # Log to file and MinKNOW interface
+            logger.info("Loading mapper for {} in the background".format(new_reference))
+            send_message(
+                client.connection,
+                "Loading new reference. ReadFish continues with the current one.",
+                Severity.INFO,
+            )
+            if loading is not None:
+                # Superseded before it finished, free it when it does
+                loading[1].add_done_callback(
+                    lambda f: f.exception() is None and f.result().free()
                 )
-        ):
-            r += 1
-            read_start_time = timer()
+            loading = (
+                new_reference,
+                index_loader.submit(CustomMapper, new_reference, threads=mapper.threads),
+            )
+
+    def swap_mapper():
+        nonlocal mapper, loading
+        if loading is not None and loading[1].done():
+            new_reference, future = loading
+            loading = None
+            try:
+                new_mapper = future.result()
+            except Exception as e:
+                logger.error("Failed to load mapper for {}: {}".format(new_reference, e))
+                send_message(client.connection, "Failed to load new reference.", Severity.ERROR)
+            else:
+                # Batches already mapping finish with the old mapper, which
+                #  may still be used by other devices or workers
+                if mapper.retire():
+                    retired.append(mapper)
+                mapper = new_mapper.share()
+                # Log on success
+                logger.info("Reloaded mapper")
+                send_message(client.connection, "Reloaded mapper.", Severity.INFO)
+
+        for old in [m for m in retired if not m.busy()]:
+            retired.remove(old)
+            old.free()
+            # If we've reloaded a reference, delete the previous one
+            if old.index:
+                logger.info("Deleting old mmi {}".format(old.index))
+                # We now delete the old mmi file.
+                Path(old.index).unlink()
+                logger.info("Old mmi deleted.")
+
+    def refresh():
+        reload()
+        swap_mapper()
+
+    # Calls dropped by `decide` because their read was already decided
+    dropped = 0
+
+    def decide(batch, loop_counter, t0):
+        nonlocal dropped
+        r = 0
+        sent = actions.sent
+
+        # Reads decided since they were fetched, e.g. while an earlier batch
+        #  was in the pipeline or on the event loop, are not acted on again
+        channels, read_numbers = read_info_arrays(batch)
+        keep = state.undecided(channels, read_numbers)
+        if not keep.all():
+            dropped += len(batch) - int(keep.sum())
+            batch = [b for b, k in zip(batch, keep) if k]
+            channels, read_numbers = channels[keep], read_numbers[keep]
+
+        # count how often each read has been seen
+        counts = state.update(channels, read_numbers)
+
+        start_analysis = timer()
+        decisions = classify_batch(batch, counts, plan, fixed_actions=prescreen.actions)
+        end_analysis = timer()
+
+        for r, (read_info, read_id, seq_len, results) in enumerate(batch, start=1):
+            i = r - 1
             channel, read_number = read_info
-            if read_number not in tracker[channel]:
-                tracker[channel].clear()
-            tracker[channel][read_number] += 1
+            # Reads that were not basecalled have an outcome, not alignments
+            for result in ([] if isinstance(results, str) else results):
+                pf.debug("{}\t{}\t{}".format(read_id, seq_len, result))
 
-            mode = ""
-            exceeded_threshold = False
-            below_threshold = False
+            actions.add(decisions.actions[i], channel, read_number, read_id)
 
-            log_decision = lambda: cl.debug(
+            mode = OUTCOMES[decisions.modes[i]]
+            cond = decisions.conditions[i]
+            cl.debug(
                 l_string.format(
                     loop_counter,
                     r,
@@ -263,121 +604,123 @@ def simple_analysis(
                     channel,
                     read_number,
                     seq_len,
-                    tracker[channel][read_number],
+                    counts[i],
                     mode,
-                    getattr(conditions[run_info[channel]], mode, mode),
-                    conditions[run_info[channel]].name,
-                    below_threshold,
-                    exceeded_threshold,
-                    read_start_time,
-                    timer(),
+                    decision_name(mode, cond),
+                    plan.names[cond],
+                    decisions.below[i],
+                    decisions.exceeded[i],
+                    start_analysis,
+                    end_analysis,
                     time.time(),
                 )
             )
 
-            # Control channels
-            if conditions[run_info[channel]].control:
-                mode = "control"
-                log_decision()
-                client.stop_receiving_read(channel, read_number)
-                continue
+        state.decide(channels[decisions.decided], read_numbers[decisions.decided])
+        actions.flush()
+        t1 = timer()
+        if r > 0:
+            s1 = "{}R/{:.5f}s, {} actions sent"
+            logger.info(s1.format(r, t1 - t0, actions.sent - sent))
+        return t1
 
-            # This is an analysis channel
-            # Below minimum chunks
-            if tracker[channel][read_number] <= conditions[run_info[channel]].min_chunks:
-                below_threshold = True
+    loop_counter = 0
+    if use_asyncio:
+        def fetch_ready():
+            # Run in the event loop's executor, it blocks on the client and
+            #  on reloading the live TOML
+            refresh()
+            # TODO: Fix the logging to just one of the two in use
+            if not mapper.initialised:
+                return None
+            return fetch()
+
+        def decide_next(batch):
+            nonlocal loop_counter
+            loop_counter += 1
+            decide(batch, loop_counter, timer())
+
+        async def run_async():
+            # Created here so that it belongs to this thread's event loop
+            async_caller = AsyncGuppyCaller(
+                caller,
+                window_overlap=window_overlap,
+                timeout=basecall_timeout,
+                max_in_flight=max_in_flight,
+            )
+            try:
+                await run_event_loop(
+                    async_caller,
+                    fetch=fetch_ready,
+                    align=align,
+                    decide=decide_next,
+                    running=lambda: client.is_running,
+                    wait=lambda timeout: wait_for_chunks(client, timeout),
+                    signal_dtype=client.signal_dtype,
+                    prev_signal=previous_signal,
+                    decided_reads=state,
+                    throttle=throttle,
+                    max_batch=batch_size,
+                    max_age=max_chunk_age,
+                    prescreen=prescreen,
+                )
+            finally:
+                logger.info("Event loop: {}".format(async_caller.stats()))
 
-            # Greater than or equal to maximum chunks
-            if tracker[channel][read_number] >= conditions[run_info[channel]].max_chunks:
-                exceeded_threshold = True
+        event_loop = asyncio.new_event_loop()
+        try:
+            event_loop.run_until_complete(run_async())
+        finally:
+            event_loop.close()
 
-            # No mappings
-            if not results:
-                mode = "no_map"
+    try:
+        while client.is_running and not use_asyncio:
+            refresh()
 
-            hits = set()
-            for result in results:
-                pf.debug("{}\t{}\t{}".format(read_id, seq_len, result))
-                hits.add(result.ctg)
-
-            if hits & conditions[run_info[channel]].targets:
-                # Mappings and targets overlap
-                coord_match = any(
-                    between(r.r_st, c)
-                    for r in results
-                    for c in conditions[run_info[channel]]
-                        .coords.get(strand_converter.get(r.strand), {})
-                        .get(r.ctg, [])
-                )
-                if len(hits) == 1:
-                    if coord_match:
-                        # Single match that is within coordinate range
-                        mode = "single_on"
-                    else:
-                        # Single match to a target outside coordinate range
-                        mode = "single_off"
-                elif len(hits) > 1:
-                    if coord_match:
-                        # Multiple matches with at least one in the correct region
-                        mode = "multi_on"
-                    else:
-                        # Multiple matches to targets outside the coordinate range
-                        mode = "multi_off"
+            # TODO: Fix the logging to just one of the two in use
 
-            else:
-                # No matches in mappings
-                if len(hits) > 1:
-                    # More than one, off-target, mapping
-                    mode = "multi_off"
-                elif len(hits) == 1:
-                    # Single off-target mapping
-                    mode = "single_off"
-
-            # This is where we make our decision:
-            # Get the associated action for this condition
-            decision_str = getattr(conditions[run_info[channel]], mode)
-            # decision is an alias for the functions "unblock" or "stop_receiving"
-            decision = decision_dict[decision_str]
-
-            # If max_chunks has been exceeded AND we don't want to keep sequencing we unblock
-            if exceeded_threshold and decision_str != "stop_receiving":
-                mode = "exceeded_max_chunks_unblocked"
-                client.unblock_read(channel, read_number, unblock_duration, read_id)
-
-            # TODO: WHAT IS GOING ON?!
-            #  I think that this needs to change between enrichment and depletion
-            # If under min_chunks AND any mapping mode seen we unblock
-            # if below_threshold and mode in {"single_off", "multi_off"}:
-            if below_threshold and mode in {
-                "single_on",
-                "single_off",
-                "multi_on",
-                "multi_off",
-            }:
-                mode = "below_min_chunks_unblocked"
-                client.unblock_read(channel, read_number, unblock_duration, read_id)
-
-            # proceed returns None, so we send no decision; otherwise unblock or stop_receiving
-            elif decision is not None:
-                decided_reads[channel] = read_id
-                decision(channel, read_number)
-
-            log_decision()
+            if not mapper.initialised:
+                time.sleep(throttle)
+                continue
 
-        t1 = timer()
-        if r > 0:
-            s1 = "{}R/{:.5f}s"
-            logger.info(s1.format(r, t1 - t0))
-        # limit the rate at which we make requests
-        if t0 + throttle > t1:
-            time.sleep(throttle + t0 - t1)
-    else:
+            loop_counter += 1
+            t0 = timer()
+
+            if stages is None:
+                batch = align(basecall(fetch(), stream=max_in_flight is not None))
+            else:
+                batch = stages.get(timeout=throttle) or []
+                t0 = timer()
+
+            t1 = decide(batch, loop_counter, t0)
+            if stages is not None:
+                # the pipeline paces itself, report where the time is going
+                stages.task_done(t1 - t0)
+                if t1 - last_stats > 10:
+                    logger.info("Pipeline: {}".format(stages.stats()))
+                    last_stats = t1
+            # limit the rate at which we make requests, waking early if the
+            #  read cache is watched and chunks arrive
+            elif t0 + throttle > t1:
+                wait_for_chunks(client, throttle + t0 - t1)
+    finally:
         send_message(client.connection, "ReadFish Client Stopped.", Severity.WARN)
+        actions.flush()
+        logger.info("Sent {}".format(actions.stats()))
+        logger.info("Channels: {}, {} calls for decided reads dropped".format(state.summary(), dropped))
+        logger.info("Signal: {}".format(previous_signal.stats()))
+        logger.info("Basecaller: {}".format(caller.stats()))
+        if prescreen:
+            logger.info("Pre-screen: {}".format(prescreen.stats()))
+        if stages is not None:
+            stages.join(timeout=3)
+            logger.info("Pipeline: {}".format(stages.stats()))
         caller.disconnect()
+        index_loader.shutdown(wait=False)
         logger.info("Finished analysis of reads as client stopped.")
 
 
-def run_workflow(client, analysis_worker, n_workers, run_time, runner_kwargs=None):
+def run_workflow(client, analysis_worker, n_workers, run_time, runner_kwargs=None, dispatcher=None, stop=None):
     """Run an analysis function against a ReadUntilClient
 
     Parameters
@@ -392,6 +735,11 @@ def run_workflow(client, analysis_worker, n_workers, run_time, runner_kwargs=Non
         Time, in seconds, to run the analysis for
     runner_kwargs : dict
         Keyword arguments to pass to client.run()
+    dispatcher : ru.dispatch.ChannelDispatcher, optional
+        If given, each worker is called with `client=` a proxy that only receives
+        reads from the channels that the dispatcher assigns to it
+    stop : threading.Event, optional
+        If set before `run_time` has passed, the run is ended early
 
     Returns
     -------
@@ -401,6 +749,8 @@ def run_workflow(client, analysis_worker, n_workers, run_time, runner_kwargs=Non
     """
     if runner_kwargs is None:
         runner_kwargs = dict()
+    if stop is None:
+        stop = threading.Event()
 
     logger = logging.getLogger("Manager")
 
@@ -411,14 +761,23 @@ def run_workflow(client, analysis_worker, n_workers, run_time, runner_kwargs=Non
         # start the client
         client.run(**runner_kwargs)
         # start a pool of workers
-        for _ in range(n_workers):
-            results.append(pool.apply_async(analysis_worker))
+        if dispatcher is None:
+            for _ in range(n_workers):
+                results.append(pool.apply_async(analysis_worker))
+        else:
+            dispatcher.start()
+            for i in range(n_workers):
+                results.append(
+                    pool.apply_async(analysis_worker, kwds={"client": dispatcher.client_for(i)})
+                )
         pool.close()
         # wait a bit before closing down
-        time.sleep(run_time)
+        stop.wait(run_time)
         logger.info("Sending reset")
         client.reset()
         pool.join()
+        if dispatcher is not None:
+            dispatcher.join(timeout=3)
     except KeyboardInterrupt:
         logger.info("Caught ctrl-c, terminating workflow.")
         client.reset()
@@ -445,61 +804,179 @@ def run_workflow(client, analysis_worker, n_workers, run_time, runner_kwargs=Non
     return collected
 
 
+def run_processes(client, dispatcher, run_time, unblock_duration=0.1, runner_kwargs=None, stop=None):
+    """Run forked analysis workers against a ReadUntilClient
+
+    Parameters
+    ----------
+    client : read_until.ReadUntilClient
+        An instance of the ReadUntilClient object
+    dispatcher : ru.dispatch.ProcessDispatcher
+        Dispatcher whose worker processes have already been started
+    run_time : int
+        Time, in seconds, to run the analysis for
+    unblock_duration : int or float
+        Time, in seconds, to apply unblock voltage
+    runner_kwargs : dict
+        Keyword arguments to pass to client.run()
+    stop : threading.Event, optional
+        If set before `run_time` has passed, the run is ended early
+
+    Returns
+    -------
+    None
+    """
+    if runner_kwargs is None:
+        runner_kwargs = dict()
+    if stop is None:
+        stop = threading.Event()
+
+    logger = logging.getLogger("Manager")
+    try:
+        # start the client
+        client.run(**runner_kwargs)
+        dispatcher.attach(client, unblock_duration=unblock_duration)
+        # wait a bit before closing down
+        stop.wait(run_time)
+        logger.info("Sending reset")
+        client.reset()
+    except KeyboardInterrupt:
+        logger.info("Caught ctrl-c, terminating workflow.")
+        client.reset()
+    except Exception as e:
+        logger.exception("Got exception", exc_info=e)
+        client.reset()
+        dispatcher.stop()
+        raise
+    dispatcher.stop()
+
+
 def main():
     sys.exit(
         "This entry point is deprecated, please use 'readfish targets' instead"
     )
 
 
-def run(parser, args):
-    # set up logging to file for DEBUG messages and above
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format="%(asctime)s %(name)s %(message)s",
-        filename=args.log_file,
-        filemode="w",
-    )
+def _device_path(path, device, n_devices):
+    """Give each device its own log file when more than one is run
 
-    # define a Handler that writes INFO messages or higher to the sys.stderr
-    console = logging.StreamHandler()
-    console.setLevel(logging.INFO)
+    >>> _device_path("chunk_log.log", "X1", 2)
+    'chunk_log_X1.log'
+    >>> _device_path("chunk_log.log", "X1", 1)
+    'chunk_log.log'
+    """
+    if path is None or n_devices == 1:
+        return path
+    p = Path(path)
+    return str(p.with_name("{}_{}{}".format(p.stem, device, p.suffix)))
 
-    # set a format which is simpler for console use
-    formatter = logging.Formatter(args.log_format)
-    console.setFormatter(formatter)
 
-    # add the handler to the root logger
-    logging.getLogger("").addHandler(console)
+def run_device(args, device, toml_path, mapper, n_devices=1, stop=None, caller=None):
+    """Run targeted sequencing on one sequencing position
 
-    # Start by logging sys.argv and the parameters used
-    logger = logging.getLogger("Manager")
-    logger.info(" ".join(sys.argv))
-    print_args(args, logger=logger)
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed command line arguments, `device` and `toml` are ignored
+    device : str
+        Name of the sequencing position
+    toml_path : str
+        TOML file for this position
+    mapper : ru.basecall.Mapper
+        Loaded mapper, shared with the other positions using the same reference
+    n_devices : int
+        Number of positions run by this process, with more than one the logs
+        of each position are kept apart
+    stop : threading.Event, optional
+        Set from another thread to end the run before `args.run_time`
+    caller : ru.basecall.GuppyCaller or ru.basecall.GuppyCallerPool, optional
+        Basecaller connection shared with the other positions using the same
+        `caller_settings`, if not given each worker opens its own
+
+    Returns
+    -------
+    None
+    """
+    def named(base):
+        return base if n_devices == 1 else "{}.{}".format(base, device)
+
+    logger = logging.getLogger(named("Manager"))
 
     # Setup chunk and paf logs
-    chunk_logger = setup_logger("DEC", log_file=args.chunk_log)
-    paf_logger = setup_logger("PAF", log_file=args.paf_log)
+    chunk_logger = setup_logger(named("DEC"), log_file=_device_path(args.chunk_log, device, n_devices))
+    paf_logger = setup_logger(named("PAF"), log_file=_device_path(args.paf_log, device, n_devices))
 
     # Parse configuration TOML
     # TODO: num_channels is not configurable here, should be inferred from client
-    run_info, conditions, reference, caller_kwargs = get_run_info(args.toml, num_channels=512)
-    live_toml = Path("{}_live".format(args.toml))
+    run_info, conditions, reference, caller_kwargs, plan = get_run_info(toml_path, num_channels=512)
+    live_toml = Path("{}_live".format(toml_path))
+
+    # The signal budget is for the whole process, each analysis gets a share
+    signal_budget = args.signal_budget
+    if signal_budget is not None:
+        signal_budget /= n_devices * (args.processes if args.processes > 0 else args.workers)
+
+    # FIXME: currently flowcell size is not included, this should be pulled from
+    #  the read_until_client
+    analysis_worker = functools.partial(
+        simple_analysis,
+        unblock_duration=args.unblock_duration,
+        throttle=args.throttle,
+        batch_size=args.batch_size,
+        cl=chunk_logger,
+        pf=paf_logger,
+        live_toml_path=live_toml,
+        dry_run=args.dry_run,
+        run_info=run_info,
+        conditions=conditions,
+        mapper=mapper,
+        caller_kwargs=caller_kwargs,
+        plan=plan,
+        action_batch_size=args.action_batch_size,
+        action_max_wait=args.action_max_wait,
+        pipeline=args.pipeline,
+        pipeline_depth=args.pipeline_depth,
+        window_overlap=args.window_overlap,
+        basecall_timeout=args.basecall_timeout,
+        max_in_flight=args.max_in_flight,
+        use_asyncio=args.asyncio,
+        max_chunk_age=args.max_chunk_age,
+        prescreen=load_config_toml(toml_path).get("prescreen"),
+        signal_budget=signal_budget,
+        max_read_samples=args.max_read_samples,
+        device=None if n_devices == 1 else device,
+        caller=caller,
+    )
 
-    # Load Minimap2 index
-    logger.info("Initialising minimap2 mapper")
-    mapper = CustomMapper(reference)
-    logger.info("Mapper initialised")
+    # Worker processes are forked now, while they can share the index loaded
+    #  above and before the ReadUntilClient starts any threads
+    process_dispatcher = None
+    if args.processes > 0:
+        process_dispatcher = ProcessDispatcher(
+            analysis_worker,
+            args.processes,
+            batch_size=args.batch_size,
+            throttle=args.throttle,
+        )
+        process_dispatcher.start()
 
     read_until_client = read_until.ReadUntilClient(
         mk_host=args.host,
         mk_port=args.port,
-        device=args.device,
+        device=device,
         # one_chunk=args.one_chunk,
         filter_strands=True,
         # TODO: test cache_type by passing a function here
         cache_type=args.read_cache,
         cache_size=args.cache_size,
     )
+    if args.wake_fill > 0 or args.max_chunk_age is not None:
+        # Wake the analysis as soon as enough chunks are waiting instead of
+        #  sleeping for the rest of the throttle interval, and stamp chunks
+        #  with the time they arrived
+        read_until_client.data_queue = WatchedCache(
+            read_until_client.data_queue, fill=args.wake_fill
+        )
 
     send_message(
         read_until_client.connection,
@@ -525,35 +1002,45 @@ def run(parser, args):
     reads will be unblocked when [u,v], sequenced when [w,x] and polled for more data when [y,z].
     """
 
-    # FIXME: currently flowcell size is not included, this should be pulled from
-    #  the read_until_client
-    analysis_worker = functools.partial(
-        simple_analysis,
-        read_until_client,
-        unblock_duration=args.unblock_duration,
-        throttle=args.throttle,
-        batch_size=args.batch_size,
-        cl=chunk_logger,
-        pf=paf_logger,
-        live_toml_path=live_toml,
-        dry_run=args.dry_run,
-        run_info=run_info,
-        conditions=conditions,
-        mapper=mapper,
-        caller_kwargs=caller_kwargs,
-    )
+    runner_kwargs = {
+        # "min_chunk_size": args.min_chunk_size,
+        "first_channel": min(args.channels),
+        "last_channel": max(args.channels),
+    }
+
+    if process_dispatcher is not None:
+        run_processes(
+            read_until_client,
+            process_dispatcher,
+            args.run_time,
+            unblock_duration=args.unblock_duration,
+            runner_kwargs=runner_kwargs,
+            stop=stop,
+        )
+    else:
+        # With more than one worker, route each channel to a fixed worker so that
+        #  successive chunks of a read are always seen by the same worker
+        dispatcher = None
+        if args.workers > 1:
+            dispatcher = ChannelDispatcher(
+                read_until_client,
+                args.workers,
+                batch_size=args.batch_size,
+                throttle=args.throttle,
+            )
 
-    results = run_workflow(
-        read_until_client,
-        analysis_worker,
-        args.workers,
-        args.run_time,
-        runner_kwargs={
-            # "min_chunk_size": args.min_chunk_size,
-            "first_channel": min(args.channels),
-            "last_channel": max(args.channels),
-        },
-    )
+        results = run_workflow(
+            read_until_client,
+            functools.partial(analysis_worker, client=read_until_client),
+            args.workers,
+            args.run_time,
+            runner_kwargs=runner_kwargs,
+            dispatcher=dispatcher,
+            stop=stop,
+        )
+
+    if isinstance(read_until_client.data_queue, WatchedCache):
+        logger.info("Read cache: {}".format(read_until_client.data_queue.stats()))
 
     # No results returned
     send_message(
@@ -563,5 +1050,98 @@ def run(parser, args):
     )
 
 
+def run(parser, args):
+    # set up logging to file for DEBUG messages and above
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s %(name)s %(message)s",
+        filename=args.log_file,
+        filemode="w",
+    )
+
+    # define a Handler that writes INFO messages or higher to the sys.stderr
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+
+    # set a format which is simpler for console use
+    formatter = logging.Formatter(args.log_format)
+    console.setFormatter(formatter)
+
+    # add the handler to the root logger
+    logging.getLogger("").addHandler(console)
+
+    # Start by logging sys.argv and the parameters used
+    logger = logging.getLogger("Manager")
+    logger.info(" ".join(sys.argv))
+    print_args(args, logger=logger)
+
+    # Each device takes the TOML at the same position, or all share one
+    devices, tomls = args.device, args.toml
+    if len(tomls) == 1:
+        tomls = tomls * len(devices)
+    if len(tomls) != len(devices):
+        parser.error("give one --toml, or one for each --device")
+    if len(set(devices)) != len(devices):
+        parser.error("each --device can only be given once")
+    if len(devices) > 1 and args.processes > 0:
+        parser.error("--processes can only be used with a single --device")
+
+    # Load Minimap2 index, once for each reference, and connect to the
+    #  basecaller once for each `caller_settings`. Forked worker processes
+    #  can not share a connection, so they each open their own.
+    mappers = {}
+    callers = {}
+    experiments = []
+    try:
+        for device, toml_path in zip(devices, tomls):
+            config = load_config_toml(toml_path)
+            reference = config["conditions"].get("reference")
+            if reference not in mappers:
+                logger.info("Initialising minimap2 mapper")
+                mappers[reference] = CustomMapper(
+                    reference, threads=args.map_threads, server=args.map_server
+                )
+                logger.info("Mapper initialised")
+            caller = None
+            if args.processes == 0:
+                settings = config["caller_settings"]
+                key = repr(sorted(settings.items()))
+                if key not in callers:
+                    callers[key] = get_caller(settings)
+                caller = callers[key]
+            experiments.append((device, toml_path, mappers[reference], caller))
+
+        if len(experiments) == 1:
+            device, toml_path, mapper, caller = experiments[0]
+            run_device(args, device, toml_path, mapper, caller=caller)
+            return
+
+        # Every position is run on its own thread, sharing the mappers and
+        #  basecaller connections above
+        stop = threading.Event()
+        threads = [
+            threading.Thread(
+                target=run_device,
+                args=(args, device, toml_path, mapper, len(experiments), stop, caller),
+                name=device,
+            )
+            for device, toml_path, mapper, caller in experiments
+        ]
+        for t in threads:
+            t.start()
+        try:
+            for t in threads:
+                t.join()
+        except KeyboardInterrupt:
+            logger.info("Caught ctrl-c, stopping {} devices.".format(len(threads)))
+            # Each device resets its client once its wait for the run time ends
+            stop.set()
+            for t in threads:
+                t.join()
+    finally:
+        for caller in callers.values():
+            caller.disconnect()
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,152 @@
+"""state.py
+
+Per-channel read state for the analysis loop, held in fixed-size arrays
+
+"""
+from collections import namedtuple
+from timeit import default_timer as timer
+
+import numpy as np
+
+
+__all__ = ["ChannelState", "StateSnapshot"]
+
+StateSnapshot = namedtuple(
+    "StateSnapshot", ["read_number", "chunks", "decided", "last_seen"]
+)
+
+
+class ChannelState:
+    """Struct of arrays holding the state of each channel's current read
+
+    Every array is indexed by channel number. Reads are identified by their
+    read_number, which is unique within a channel, so updates are array writes
+    with no per-read allocation.
+
+    Parameters
+    ----------
+    num_channels : int
+        Total number of channels on the sequencer, the arrays grow if a higher
+        channel number is seen
+
+    Attributes
+    ----------
+    read_number : np.ndarray
+        The read_number of the current read, -1 if none has been seen
+    chunks : np.ndarray
+        The number of chunks seen for the current read
+    decided : np.ndarray
+        The read_number of the last read a decision was sent for, -1 if none
+    last_seen : np.ndarray
+        Timestamp (timeit.default_timer) of the last chunk seen
+
+    Examples
+    --------
+    >>> state = ChannelState(4)
+    >>> state.update(np.array([1, 2]), np.array([10, 20])).tolist()
+    [1, 1]
+    >>> state.update(np.array([1, 2]), np.array([10, 21])).tolist()
+    [2, 1]
+    >>> state.decide(np.array([1]), np.array([10]))
+    >>> state.is_decided(1, 10), state.is_decided(2, 21)
+    (True, False)
+    """
+
+    def __init__(self, num_channels):
+        size = num_channels + 1
+        self.read_number = np.full(size, -1, dtype=np.int64)
+        self.chunks = np.zeros(size, dtype=np.int64)
+        self.decided = np.full(size, -1, dtype=np.int64)
+        self.last_seen = np.zeros(size, dtype=float)
+
+    def __len__(self):
+        return len(self.read_number)
+
+    def _ensure(self, max_channel):
+        if max_channel < len(self):
+            return
+        grow = max_channel + 1 - len(self)
+        self.read_number = np.concatenate((self.read_number, np.full(grow, -1, dtype=np.int64)))
+        self.chunks = np.concatenate((self.chunks, np.zeros(grow, dtype=np.int64)))
+        self.decided = np.concatenate((self.decided, np.full(grow, -1, dtype=np.int64)))
+        self.last_seen = np.concatenate((self.last_seen, np.zeros(grow, dtype=float)))
+
+    def update(self, channels, read_numbers, now=None):
+        """Record a chunk for each (channel, read_number)
+
+        Parameters
+        ----------
+        channels : np.ndarray
+            Channel of each chunk
+        read_numbers : np.ndarray
+            Read number of each chunk
+        now : float, optional
+            Timestamp to record as last seen, defaults to timeit.default_timer()
+
+        Returns
+        -------
+        np.ndarray
+            The number of chunks seen so far for each read
+        """
+        if not len(channels):
+            return np.zeros(0, dtype=np.int64)
+        self._ensure(channels.max())
+        new = self.read_number[channels] != read_numbers
+        self.chunks[channels[new]] = 0
+        self.read_number[channels] = read_numbers
+        np.add.at(self.chunks, channels, 1)
+        self.last_seen[channels] = timer() if now is None else now
+        return self.chunks[channels]
+
+    def decide(self, channels, read_numbers):
+        """Record that decisions were sent for these reads"""
+        if len(channels):
+            self._ensure(channels.max())
+            self.decided[channels] = read_numbers
+
+    def is_decided(self, channel, read_number):
+        """Return True if a decision has been sent for this read"""
+        return bool(channel < len(self) and self.decided[channel] == read_number)
+
+    def undecided(self, channels, read_numbers):
+        """Return a mask of the reads that still need a decision
+
+        Reads that a decision was already sent for are excluded, as are all
+        but the last occurrence of a channel, so each channel is acted on at
+        most once per batch.
+
+        Examples
+        --------
+        >>> state = ChannelState(4)
+        >>> state.decide(np.array([1]), np.array([10]))
+        >>> state.undecided(np.array([1, 2, 3, 2]), np.array([10, 20, 30, 20])).tolist()
+        [False, False, True, True]
+        """
+        n = len(channels)
+        keep = np.zeros(n, dtype=bool)
+        if not n:
+            return keep
+        _, last = np.unique(channels[::-1], return_index=True)
+        keep[n - 1 - last] = True
+        known = channels < len(self)
+        keep[known] &= self.decided[channels[known]] != read_numbers[known]
+        return keep
+
+    def snapshot(self):
+        """Return a copy of the current state arrays"""
+        return StateSnapshot(
+            self.read_number.copy(),
+            self.chunks.copy(),
+            self.decided.copy(),
+            self.last_seen.copy(),
+        )
+
+    def summary(self, window=10):
+        """Return a summary string of channels seen in the last `window` seconds"""
+        active = (self.last_seen > 0) & (timer() - self.last_seen <= window)
+        reading = active & (self.read_number != self.decided)
+        return "{} active channels, {} undecided reads, mean {:.1f} chunks/read".format(
+            int(active.sum()),
+            int(reading.sum()),
+            float(self.chunks[active].mean()) if active.any() else 0.0,
+        )
@@ -7,6 +7,8 @@ import sys
 import toml
 import mappy as mp
 
+from ru.index import DEFAULT_PRESET, cached_index
+
 
 _help = "Summary stats from FASTQ files"
 _cli = (
@@ -84,7 +86,7 @@ def run(parser, args):
     if not Path(reference).is_file():
         raise FileNotFoundError("reference file not found at: {}".format(reference))
 
-    mapper = mp.Aligner(reference, preset="map-ont")
+    mapper = mp.Aligner(cached_index(reference), preset=DEFAULT_PRESET)
 
     print("Using reference: {}".format(reference), file=sys.stderr)
 
@@ -1,7 +1,11 @@
+import copy
+import hashlib
 import logging
+from bisect import bisect_right
 from collections import namedtuple, defaultdict
 from pathlib import Path
 from random import random
+from timeit import default_timer as timer
 import numpy as np
 import toml
 from operator import itemgetter
@@ -18,6 +22,18 @@ class Severity(IntEnum):
     ERROR = 3
 
 
+class Decision(IntEnum):
+    """Integer codes for the actions that can be taken for a read"""
+    PROCEED = 0
+    STOP_RECEIVING = 1
+    UNBLOCK = 2
+
+
+# Classification modes that are assigned an action by each condition
+MODES = ("single_on", "single_off", "multi_on", "multi_off", "no_map", "no_seq")
+MODE_INDEX = {m: i for i, m in enumerate(MODES)}
+
+
 def send_message(rpc_connection, message, severity):
     """Send a message to MinKNOW
 
@@ -316,6 +332,112 @@ def get_targets(targets):
     return t
 
 
+class CoordIndex:
+    """Sorted interval index over target coordinates
+
+    Built from the nested dict returned by `get_targets`. Overlapping regions
+    on each strand and contig are merged and stored as sorted start and end
+    arrays so that a point query is a binary search rather than a scan over
+    every region. Whole contig targets are kept in a set and answered without
+    a search.
+
+    Every (strand, contig) pair is given a group id and the regions of all
+    groups are laid out in one pair of arrays, offset by `SPAN * group`, so that
+    positions from many groups can be queried at once with `contains_many`.
+
+    Parameters
+    ----------
+    coords : dict
+        {strand: {contig: [(start, end), ...]}}, as returned by `get_targets`
+
+    Examples
+    --------
+    >>> idx = CoordIndex(get_targets(["chr1", "chr2,10,20,+", "chr2,15,40,+", "chr2,100,200,+"]))
+    >>> idx.contains("-", "chr1", 5000)
+    True
+    >>> [idx.contains("+", "chr2", p) for p in (9, 10, 40, 41, 150)]
+    [False, True, True, False, True]
+    >>> idx.contains("-", "chr2", 15)
+    False
+    >>> idx.contains("+", "chr3", 15)
+    False
+    """
+
+    # Upper bound on a reference position; separates groups in the flat arrays
+    SPAN = 2 ** 40
+
+    def __init__(self, coords):
+        self.whole = set()
+        self.groups = {}
+        starts, ends = [], []
+        for strand, contigs in coords.items():
+            for ctg, regions in contigs.items():
+                key = (strand, ctg)
+                offset = len(self.groups) * self.SPAN
+                self.groups[key] = len(self.groups)
+                if any(max(r) == float("inf") for r in regions):
+                    self.whole.add(key)
+                    starts.append(offset)
+                    ends.append(offset + self.SPAN - 1)
+                    continue
+                merged = []
+                for st, en in sorted((min(r), max(r)) for r in regions):
+                    if merged and st <= merged[-1][1]:
+                        merged[-1][1] = max(merged[-1][1], en)
+                    else:
+                        merged.append([st, en])
+                for st, en in merged:
+                    starts.append(offset + st)
+                    ends.append(offset + en)
+
+        self._starts = starts
+        self._ends = ends
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def group(self, strand, ctg):
+        """Return the group id for a strand and contig, -1 if not a target"""
+        return self.groups.get((strand, ctg), -1)
+
+    def contains(self, strand, ctg, pos):
+        """Return True if `pos` on `strand` of `ctg` falls within a target"""
+        key = (strand, ctg)
+        if key in self.whole:
+            return True
+        gid = self.groups.get(key)
+        if gid is None:
+            return False
+        pos += gid * self.SPAN
+        i = bisect_right(self._starts, pos) - 1
+        return i >= 0 and pos <= self._ends[i]
+
+    def contains_many(self, groups, positions):
+        """Vectorised `contains` over arrays of group ids and positions
+
+        Parameters
+        ----------
+        groups : np.ndarray
+            Group ids from `CoordIndex.group`, -1 for non-targets
+        positions : np.ndarray
+            Reference positions to check
+
+        Returns
+        -------
+        np.ndarray
+            bool array, True where the position falls within a target
+        """
+        groups = np.asarray(groups, dtype=np.int64)
+        keys = groups * self.SPAN + np.asarray(positions, dtype=np.int64)
+        i = np.searchsorted(self.starts, keys, side="right") - 1
+        found = (groups >= 0) & (i >= 0)
+        if not len(self.ends):
+            return found
+        return found & (keys <= self.ends[np.maximum(i, 0)])
+
+
 def load_config_toml(filepath, validate=True):
     """Load a TOML file and check file paths
 
@@ -406,7 +528,7 @@ def describe_experiment(conditions, mapper):
                 "stop_receiving": [],
                 "proceed": [],
             }
-            for m in ("single_on", "single_off", "multi_on", "multi_off", "no_map", "no_seq"):
+            for m in MODES:
                 conds[getattr(region, m)].append(m)
             conds = {k: nice_join(v) for k, v in conds.items()}
             s = (
@@ -430,7 +552,7 @@ def describe_experiment(conditions, mapper):
                 "stop_receiving": [],
                 "proceed": [],
             }
-            for m in ("single_on", "single_off", "multi_on", "multi_off", "no_map", "no_seq"):
+            for m in MODES:
                 conds[getattr(region, m)].append(m)
             conds = {k: nice_join(v) for k, v in conds.items()}
             s = (
@@ -470,9 +592,37 @@ def get_run_info(toml_filepath, num_channels=512):
     caller_settings : dict
         kwargs to pass to the base caller. If not found in the TOML an empty dict
         is returned
+    plan : ExperimentPlan
+        Per-channel arrays compiled from `run_info` and `split_conditions`
     """
     toml_dict = load_config_toml(toml_filepath)
+    return _compile_run_info(toml_dict, num_channels)
+
 
+def _compile_targets(targets, cache=None):
+    """Return (coords, coord_index, contig names) for a condition's targets
+
+    `cache` maps a tuple of targets to a previous result, which is reused
+    """
+    key = tuple(targets)
+    if cache is not None and key in cache:
+        return cache[key]
+    coords = get_targets(targets)
+    names = set()
+    for strand in coords.values():
+        names.update(strand.keys())
+    compiled = (coords, CoordIndex(coords), names)
+    if cache is not None:
+        cache[key] = compiled
+    return compiled
+
+
+def _compile_run_info(toml_dict, num_channels, target_cache=None):
+    """Build the return values of `get_run_info` from a loaded TOML dict
+
+    Conditions whose targets are in `target_cache` reuse the coordinates
+    compiled for them before, see `_compile_targets`
+    """
     # Get condition keys, these should be ascending integers
     conditions = [
         k for k in toml_dict["conditions"].keys()
@@ -497,13 +647,9 @@ def get_run_info(toml_filepath, num_channels=512):
         cond = toml_dict["conditions"].get(k)
         if not isinstance(cond, dict):
             continue
-        cond["coords"] = get_targets(cond["targets"])
-
-        _t = []
-        for _k in cond["coords"].keys():
-            _t.extend(cond["coords"].get(_k).keys())
-
-        cond["targets"] = set(_t)
+        cond["coords"], cond["coord_index"], cond["targets"] = _compile_targets(
+            cond["targets"], target_cache
+        )
 
     # Create a list of named tuples, these are the conditions
     split_conditions = [
@@ -522,8 +668,294 @@ def get_run_info(toml_filepath, num_channels=512):
 
     reference = toml_dict["conditions"].get("reference")
     caller_settings = toml_dict.get("caller_settings", {})
+    plan = ExperimentPlan(run_info, split_conditions, num_channels)
+
+    return run_info, split_conditions, reference, caller_settings, plan
+
+
+TOMLChange = namedtuple(
+    "TOMLChange",
+    ["run_info", "conditions", "reference", "caller_settings", "plan", "changed", "elapsed"],
+)
+
+# The parts of an experiment that `diff_config` reports
+CONFIG_PARTS = ("layout", "names", "targets", "coords", "thresholds", "actions", "reference", "caller_settings")
+_THRESHOLDS = ("min_chunks", "max_chunks", "min_seq_len")
+
+
+def diff_config(old, new):
+    """Return the parts of the experiment that differ between two TOML dicts
+
+    Parameters
+    ----------
+    old : dict or None
+        Previously loaded TOML, if None every part is reported
+    new : dict
+        Newly loaded TOML, from `load_config_toml`
+
+    Returns
+    -------
+    set
+        Names from CONFIG_PARTS. `targets` are whole contig targets and
+        `coords` are targets with coordinates.
+
+    Examples
+    --------
+    >>> old = {"conditions": {"reference": "a.mmi", "0": {"targets": ["chr1"], "min_chunks": 0}}}
+    >>> new = {"conditions": {"reference": "a.mmi", "0": {"targets": ["chr1", "chr2,1,9,+"], "min_chunks": 1}}}
+    >>> sorted(diff_config(old, new))
+    ['coords', 'thresholds']
+    >>> diff_config(new, new)
+    set()
+    """
+    if old is None:
+        return set(CONFIG_PARTS)
+    changed = set()
+    if old.get("caller_settings") != new.get("caller_settings"):
+        changed.add("caller_settings")
+
+    old_conds, new_conds = old.get("conditions", {}), new.get("conditions", {})
+    if old_conds.get("reference") != new_conds.get("reference"):
+        changed.add("reference")
+    old_keys = sorted(k for k, v in old_conds.items() if isinstance(v, dict))
+    new_keys = sorted(k for k, v in new_conds.items() if isinstance(v, dict))
+    if old_keys != new_keys or any(
+        old_conds.get(k) != new_conds.get(k) for k in ("axis", "maintain_order")
+    ):
+        changed.add("layout")
+
+    for k in set(old_keys) & set(new_keys):
+        a, b = old_conds[k], new_conds[k]
+        a_targets, b_targets = set(a.get("targets", [])), set(b.get("targets", []))
+        if {t for t in a_targets if "," not in t} != {t for t in b_targets if "," not in t}:
+            changed.add("targets")
+        if {t for t in a_targets if "," in t} != {t for t in b_targets if "," in t}:
+            changed.add("coords")
+        if any(a.get(t) != b.get(t) for t in _THRESHOLDS):
+            changed.add("thresholds")
+        if any(a.get(m) != b.get(m) for m in MODES + ("control",)):
+            changed.add("actions")
+        if a.get("name") != b.get("name"):
+            changed.add("names")
+    return changed
+
+
+def _target_files(toml_dict):
+    """Return the target files named by the conditions of a raw TOML dict
+
+    >>> _target_files({"conditions": {"reference": "r.mmi", "0": {"targets": "t.txt"},
+    ...                               "1": {"targets": ["chr1"]}}})
+    ['t.txt']
+    """
+    return sorted(
+        {
+            cond["targets"]
+            for cond in toml_dict.get("conditions", {}).values()
+            if isinstance(cond, dict) and isinstance(cond.get("targets"), str)
+        }
+    )
+
+
+def _stat_stamp(path):
+    try:
+        st = Path(path).stat()
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class LiveTOMLWatcher:
+    """Reload a live TOML file only when its content changes
+
+    `poll` is cheap enough to call on every iteration of the analysis loop: it
+    only reads the file when its modification time or size changes, and only
+    parses it when the content hash changes too. Target files named by a
+    condition are watched in the same way, so editing one reloads the TOML
+    even when the TOML itself is unchanged. Target coordinates are
+    compiled again only for conditions whose targets changed, the rest are
+    reused from the previous load.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the live TOML file
+    num_channels : int
+        Total number of channels on the sequencer, see `get_run_info`
+
+    Attributes
+    ----------
+    config : dict or None
+        The TOML as last loaded, before targets are compiled
+    reloads : int
+        The number of times the file was reloaded
+    """
+
+    def __init__(self, path, num_channels):
+        self.path = Path(path)
+        self.num_channels = num_channels
+        self.stamp = None
+        self.digest = None
+        self.config = None
+        self.target_files = []
+        self.target_cache = {}
+        self.reloads = 0
+
+    def _stamp(self, toml_stamp):
+        return (toml_stamp,) + tuple(_stat_stamp(f) for f in self.target_files)
+
+    def poll(self):
+        """Reload the file if it has changed
+
+        Returns
+        -------
+        TOMLChange or None
+            The values from `get_run_info`, the set of changed parts (see
+            `diff_config`) and the time taken, or None if nothing changed.
+            A file that fails to load raises, and is not loaded again until
+            it or one of its target files is modified.
+        """
+        toml_stamp = _stat_stamp(self.path)
+        if toml_stamp is None:
+            self.stamp = None
+            return None
+        stamp = self._stamp(toml_stamp)
+        if stamp == self.stamp:
+            return None
+
+        toml_changed = self.stamp is None or toml_stamp != self.stamp[0]
+        self.stamp = stamp
+
+        t0 = timer()
+        data = self.path.read_bytes()
+        if toml_changed:
+            # The TOML may now name different target files
+            self.target_files = _target_files(toml.loads(data.decode()))
+            self.stamp = self._stamp(toml_stamp)
+        h = hashlib.sha1(data)
+        for f in self.target_files:
+            h.update(f.encode())
+            if Path(f).is_file():
+                h.update(Path(f).read_bytes())
+        digest = h.hexdigest()
+        if digest == self.digest:
+            return None
+        toml_dict = load_config_toml(self.path)
+        self.digest = digest
+
+        config = copy.deepcopy(toml_dict)
+        changed = diff_config(self.config, config)
+        self.config = config
+        if not changed:
+            return None
+
+        cache = self.target_cache
+        self.target_cache = {}
+        for k, cond in toml_dict["conditions"].items():
+            key = tuple(cond["targets"]) if isinstance(cond, dict) else None
+            if key in cache:
+                self.target_cache[key] = cache[key]
+        result = _compile_run_info(toml_dict, self.num_channels, self.target_cache)
+        self.reloads += 1
+        return TOMLChange(*result, changed, timer() - t0)
+
+
+class ExperimentPlan:
+    """Compiled, per-channel view of the experimental conditions
+
+    The analysis loop needs the condition settings for every read it sees.
+    Rather than resolving `conditions[run_info[channel]]` and calling `getattr`
+    on a namedtuple each time, the settings are compiled once into arrays that
+    are indexed by channel number and an action table that is indexed by mode
+    and condition.
+
+    Channels that are not assigned to a condition are treated as controls.
+
+    Parameters
+    ----------
+    run_info : dict
+        dict with a key per channel, the value maps to an index in `conditions`
+    conditions : list
+        List of namedtuples with conditions, from `get_run_info`
+    num_channels : int
+        Total number of channels on the sequencer
+
+    Attributes
+    ----------
+    conditions : list
+        The conditions that the plan was compiled from
+    condition : np.ndarray
+        The index into `conditions` for each channel, -1 if unassigned
+    control : np.ndarray
+        bool, True for control channels
+    min_chunks : np.ndarray
+        The min_chunks threshold for each channel
+    max_chunks : np.ndarray
+        The max_chunks threshold for each channel
+    min_seq_len : np.ndarray
+        The shortest basecalled sequence that is mapped on each channel,
+        shorter calls are classed as no_seq
+    actions : np.ndarray
+        Decision codes with shape (len(MODES), len(conditions))
+    names : list
+        Condition names, indexed by condition
+
+    Examples
+    --------
+    >>> from collections import namedtuple
+    >>> C = namedtuple("C", ["name", "control", "min_chunks", "max_chunks", *MODES])
+    >>> conds = [
+    ...     C("a", False, 0, 4, "stop_receiving", "unblock", "stop_receiving", "unblock", "proceed", "proceed"),
+    ...     C("b", True, 0, float("inf"), *["proceed"] * len(MODES)),
+    ... ]
+    >>> plan = ExperimentPlan({1: 0, 2: 1}, conds, 2)
+    >>> plan.action(1, "single_off")
+    <Decision.UNBLOCK: 2>
+    >>> plan.control.tolist()
+    [True, False, True]
+    >>> plan.max_chunks.tolist()
+    [inf, 4.0, inf]
+    >>> plan.min_seq_len.tolist()
+    [0, 0, 0]
+    """
+
+    def __init__(self, run_info, conditions, num_channels):
+        size = max(num_channels, max(run_info, default=0)) + 1
+        self.conditions = conditions
+        self.names = [c.name for c in conditions]
+
+        self.condition = np.full(size, -1, dtype=np.intp)
+        for channel, pos in run_info.items():
+            self.condition[channel] = pos
+
+        assigned = self.condition >= 0
+        idx = self.condition[assigned]
+
+        self.control = np.ones(size, dtype=bool)
+        self.control[assigned] = np.array([c.control for c in conditions], dtype=bool)[idx]
+
+        self.min_chunks = np.zeros(size, dtype=float)
+        self.min_chunks[assigned] = np.array([c.min_chunks for c in conditions], dtype=float)[idx]
+
+        self.max_chunks = np.full(size, float("inf"), dtype=float)
+        self.max_chunks[assigned] = np.array([c.max_chunks for c in conditions], dtype=float)[idx]
+
+        # Optional in the TOML, conditions without it map every call
+        self.min_seq_len = np.zeros(size, dtype=np.int64)
+        self.min_seq_len[assigned] = np.array(
+            [getattr(c, "min_seq_len", 0) for c in conditions], dtype=np.int64
+        )[idx]
+
+        self.actions = np.array(
+            [
+                [Decision[getattr(c, mode).upper()] for c in conditions]
+                for mode in MODES
+            ],
+            dtype=np.int8,
+        ).reshape(len(MODES), len(conditions))
 
-    return run_info, split_conditions, reference, caller_settings
+    def action(self, channel, mode):
+        """Return the Decision for a classification mode on a channel"""
+        return Decision(self.actions[MODE_INDEX[mode], self.condition[channel]])
 
 
 def between(pos, coords):
@@ -38,7 +38,7 @@ def run(parser, args):
     sys.excepthook = except_hook
 
     # Run load config to validate
-    run_info, conditions, reference, caller_settings = get_run_info(args.toml)
+    run_info, conditions, reference, caller_settings, plan = get_run_info(args.toml)
     print("😻 Looking good!", file=sys.stdout)
     print("Generating experiment description - please be patient!", file=sys.stdout)
     mapper = Mapper(reference)